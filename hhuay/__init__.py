@@ -9,6 +9,7 @@ import sys
 import time
 
 
+from . import snapshot
 from . import sources
 
 from .util import (
@@ -28,6 +29,7 @@ from . import actions_ipppaper
 from . import actions_tobias_export_habil15
 from . import actions_tobias_export_promo16
 from . import actions_plot
+from . import actions_pipeline
 
 
 @options([
@@ -42,9 +44,25 @@ def action_list_uas(args):
 
     config = read_config(args)
     with DBConnection(config) as db:
-        db.execute('''SELECT user_agent, COUNT(*) as count
-            FROM analysis_requestlog_combined GROUP BY user_agent''')
-        uastats_raw = list(db)
+        snap = snapshot.load_fresh_snapshot(db)
+        if snap is None:
+            db.execute('''SELECT analysis_user_agent.user_agent, _uas.count
+                FROM (
+                    SELECT user_agent_id, COUNT(*) as count
+                    FROM analysis_requestlog_combined GROUP BY user_agent_id
+                ) _uas
+                LEFT JOIN analysis_user_agent
+                    ON analysis_user_agent.id = _uas.user_agent_id''')
+            uastats_raw = list(db)
+    if snap is not None:
+        import numpy as np
+        codes = snap.column('user_agent')
+        uas = snap.dictionary('user_agent')
+        counts = np.bincount(codes[codes >= 0], minlength=len(uas)).tolist()
+        uastats_raw = list(zip(uas, counts))
+        null_count = int((codes < 0).sum())
+        if null_count:
+            uastats_raw.append((None, null_count))
 
     def summarize(ua):
         if 'Android' in ua:
@@ -87,7 +105,8 @@ def action_list_votes(args, config, db, wdb):
         print(v, )
 
 
-def main():
+def build_parser():
+    """ Return the command line parser and a dictionary of all actions """
     parser = argparse.ArgumentParser(description='Analyze adhocracy logs')
 
     common_options = argparse.ArgumentParser(add_help=False)
@@ -99,6 +118,20 @@ def main():
     common_options.add_argument(
         '--config', dest='config_filename',
         metavar='FILE', help='Configuration file', default='.config.json')
+    common_options.add_argument(
+        '--profile', dest='profile', action='store_true',
+        help='Write a report of time, memory and SQL usage into output/ '
+             '(slows down the action)')
+    common_options.add_argument(
+        '--profile-pstats', dest='profile_pstats', action='store_true',
+        help='With --profile, also write a cProfile dump into output/')
+    common_options.add_argument(
+        '--query-log', dest='query_log', action='store_true',
+        help='Time all SQL statements and write a report of the slowest '
+             'statement shapes, including their query plans, into output/')
+    common_options.add_argument(
+        '--query-log-top', dest='query_log_top', type=int, default=10,
+        metavar='N', help='Number of statement shapes to EXPLAIN')
 
     subparsers = parser.add_subparsers(
         title='action', help='What to do', dest='action')
@@ -108,6 +141,7 @@ def main():
     glbls.update(actions_sessions.__dict__)
     glbls.update(actions_misc.__dict__)
     glbls.update(actions_plot.__dict__)
+    glbls.update(actions_pipeline.__dict__)
     glbls.update(actions_ipppaper.__dict__)
     glbls.update(actions_tobias_export_habil15.__dict__)
     glbls.update(actions_tobias_export_promo16.__dict__)
@@ -122,8 +156,12 @@ def main():
             help=help, parents=[common_options])
         for o in a.option_list:
             sp.add_argument(o.name, **o.kwargs)
+    return parser, glbls
+
 
-    args = parser.parse_args()
+def main(argv=None):
+    parser, glbls = build_parser()
+    args = parser.parse_args(argv)
     if not args.action:
         parser.error('No action specified')
 
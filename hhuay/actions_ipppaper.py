@@ -105,9 +105,13 @@ def action_ipp_usage_stats(args, config, db, wdb):
     db.execute('''
         SELECT
             _sessions.session_id,
-            analysis_requestlog.ip_address,
-            analysis_requestlog.user_agent
+            analysis_ip.ip_address,
+            analysis_user_agent.user_agent
         FROM analysis_requestlog
+        LEFT JOIN analysis_ip
+            ON analysis_ip.id = analysis_requestlog.ip_id
+        LEFT JOIN analysis_user_agent
+            ON analysis_user_agent.id = analysis_requestlog.user_agent_id
         JOIN (
             SELECT
                 session_id,
@@ -1,5 +1,8 @@
 from __future__ import unicode_literals
 
+import time
+
+from . import cookies as cookies_module
 from .util import (
     options,
     Option,
@@ -57,3 +60,40 @@ def action_basicfacts(args, config, db, wdb):
         'SELECT COUNT(DISTINCT user_id, poll_id) FROM vote ' + where_q)[0]
     print('%d votings' % vote_count)
 
+
+@options([
+    Option(
+        '--repeat',
+        dest='repeat',
+        help='How often to parse the whole corpus',
+        type=int,
+        default=3),
+], requires_db=True)
+def action_benchmark_cookies(args, config, db, wdb):
+    """ Compare cookie parsing with and without the shared cache """
+
+    corpus = [
+        row[0] for row in db.stream('''
+            SELECT cookies FROM analysis_requestlog_undeleted
+            ORDER BY access_time''')
+        if row[0]]
+    print('%d cookie headers, %d distinct' % (len(corpus), len(set(corpus))))
+
+    parse_cookies = cookies_module.parse_cookies
+    start = time.time()
+    for _ in range(args.repeat):
+        for c in corpus:
+            parse_cookies.__wrapped__(c)
+    uncached_time = time.time() - start
+
+    parse_cookies.cache_clear()
+    start = time.time()
+    for _ in range(args.repeat):
+        for c in corpus:
+            parse_cookies(c)
+    cached_time = time.time() - start
+
+    print('uncached: %.3fs, cached: %.3fs (%.1fx faster)' % (
+        uncached_time, cached_time,
+        uncached_time / cached_time if cached_time > 0 else float('inf')))
+    print(cookies_module.parse_cookies.cache_info())
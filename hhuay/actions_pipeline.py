@@ -0,0 +1,218 @@
+from __future__ import unicode_literals
+
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+
+from .dbhelpers import get_generation
+from .util import (
+    Option,
+    options,
+    ROOT_DIR,
+)
+
+PIPELINE_STATE_FN = os.path.join('.cache', 'pipeline.json')
+
+# reads maps each input table to the column summed up in its fingerprint.
+# The fingerprint also contains the generation the writing action stored for
+# the table, since reloading a table usually reproduces the same ids.
+Stage = collections.namedtuple(
+    'Stage', ['name', 'argv', 'reads', 'writes', 'stdout'])
+
+
+def get_stages(session_timeout, materialize=False):
+    """ The stages of `make run`, in an order compatible with the DAG """
+    return [
+        Stage(
+            'cleanup_requestlog', [],
+            {'analysis_requestlog': 'id'},
+            ['analysis_requestlog', 'analysis_requestlog_undeleted'],
+            None),
+        Stage(
+            'annotate_requests',
+            ['--ping-timeout', '%d' % session_timeout] +
+            (['--materialize'] if materialize else []),
+            {'analysis_requestlog_undeleted': 'id'},
+            ['analysis_request_annotations', 'analysis_requestlog_combined'],
+            None),
+        Stage(
+            'assign_requestlog_sessions',
+            ['--timeout', '%d' % session_timeout],
+            {'analysis_requestlog_undeleted': 'id'},
+            ['analysis_session', 'analysis_session_requests',
+             'analysis_session_length'],
+            None),
+        Stage(
+            'list_uas', ['--summarize'],
+            {'analysis_requestlog_combined': 'id'},
+            [],
+            os.path.join(ROOT_DIR, 'output', 'uas')),
+        Stage(
+            'session_user_stats', [],
+            {'analysis_requestlog_combined': 'id',
+             'analysis_session_requests': 'request_id'},
+            ['analysis_session_users', 'analysis_session_count_per_user'],
+            None),
+        Stage(
+            'basicfacts', [],
+            {'analysis_requestlog_undeleted': 'id',
+             'analysis_request_annotations': 'id'},
+            [],
+            None),
+    ]
+
+
+def stage_dependencies(stages):
+    """ Map each stage name to the names of the earlier stages that write
+        one of its inputs """
+    res = {}
+    for idx, stage in enumerate(stages):
+        res[stage.name] = set(
+            earlier.name for earlier in stages[:idx]
+            if any(tbl in stage.reads for tbl in earlier.writes))
+    return res
+
+
+def _table_fingerprint(db, tbl, column):
+    if not db.table_exists(tbl):
+        return None
+    db.execute('SELECT COUNT(*), MAX(%s), SUM(%s) FROM %s' % (
+        column, column, tbl))
+    res = [
+        v if isinstance(v, int) or v is None else int(v)
+        for v in list(db)[0]]
+    res.append(get_generation(db, tbl))
+    return res
+
+
+def stage_fingerprint(db, stage, config):
+    # End the current transaction so that we see what other stages committed
+    db.commit()
+    data = {
+        'argv': stage.argv,
+        'config': config,
+        'inputs': {
+            tbl: _table_fingerprint(db, tbl, column)
+            for tbl, column in sorted(stage.reads.items())},
+    }
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _read_state(config_filename):
+    try:
+        with io.open(PIPELINE_STATE_FN, encoding='utf-8') as inf:
+            state = json.load(inf)
+    except IOError:
+        state = {}
+    return state.setdefault(os.path.abspath(config_filename), {}), state
+
+
+def _write_state(state):
+    if not os.path.exists('.cache'):
+        os.mkdir('.cache')
+    tmp_fn = PIPELINE_STATE_FN + '.tmp'
+    with io.open(tmp_fn, 'w', encoding='utf-8') as outf:
+        outf.write(json.dumps(state, indent=2, sort_keys=True))
+    os.rename(tmp_fn, PIPELINE_STATE_FN)
+
+
+def _run_stage(stage, config_filename):
+    """ Run one stage in a worker process, return its output """
+    from . import main
+
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        main([stage.name] + stage.argv + ['--config', config_filename])
+    output = out.getvalue()
+    if stage.stdout is not None:
+        with io.open(stage.stdout, 'w', encoding='utf-8') as outf:
+            outf.write(output)
+        return ''
+    return output
+
+
+@options([
+    Option(
+        '--force',
+        dest='force',
+        help='Run all stages, even if their inputs did not change',
+        action='store_true'),
+    Option(
+        '--dry-run',
+        dest='dry_run',
+        help='Only print which stages would run',
+        action='store_true'),
+    Option(
+        '--workers',
+        dest='workers',
+        help='Maximum number of stages to run concurrently',
+        type=int,
+        default=4),
+    Option(
+        '--session-timeout',
+        dest='session_timeout',
+        help='Session timeout in seconds',
+        type=int,
+        default=600),
+    Option(
+        '--materialize',
+        dest='materialize',
+        help='Materialize analysis_requestlog_combined as a table',
+        action='store_true'),
+], requires_db=True)
+def action_pipeline(args, config, db, wdb):
+    """ Run the prepare and run stages, skipping stages that are fresh """
+
+    stages = get_stages(args.session_timeout, args.materialize)
+    deps = stage_dependencies(stages)
+    fingerprints, state = _read_state(args.config_filename)
+
+    finished = set()
+    rerun = set()
+    # future -> (stage, fingerprint of its inputs before it ran)
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        while len(finished) < len(stages):
+            running_names = set(st.name for st, _ in running.values())
+            for stage in stages:
+                if stage.name in finished or stage.name in running_names:
+                    continue
+                if not deps[stage.name] <= finished:
+                    continue
+
+                fp = stage_fingerprint(db, stage, config)
+                if (args.force or fp != fingerprints.get(stage.name) or
+                        deps[stage.name] & rerun):
+                    if args.dry_run:
+                        print('Would run %s' % stage.name)
+                        rerun.add(stage.name)
+                        finished.add(stage.name)
+                        continue
+                    print('Running %s' % stage.name)
+                    future = executor.submit(
+                        _run_stage, stage, args.config_filename)
+                    running[future] = (stage, fp)
+                else:
+                    print('Skipping %s (up to date)' % stage.name)
+                    finished.add(stage.name)
+
+            if not running:
+                continue
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage, fp = running.pop(future)
+                name = stage.name
+                output = future.result()
+                sys.stdout.write(output)
+                print('Finished %s' % name)
+                fingerprints[name] = fp
+                _write_state(state)
+                rerun.add(name)
+                finished.add(name)
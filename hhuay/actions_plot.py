@@ -17,6 +17,11 @@ def _plot_bar_histogram(plt, fig, ax, data):
     ax.bar(xvalues, yvalues)
 
 
+def _plot_line(plt, fig, ax, data):
+    xvalues, yvalues = zip(*data['data'])
+    ax.plot(xvalues, yvalues, marker='o')
+
+
 def plot(name, type, title=None, xlabel=None, ylabel=None):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -55,3 +60,11 @@ def action_plotall(args, config, db, wdb):
         'xlabel': 'Session count',
     })
 
+    # Written by session_timeout_sweep, which is not part of `make run`
+    if os.path.exists(os.path.join(
+            ROOT_DIR, 'output', 'session_timeout_sweep.json')):
+        plot('session_timeout_sweep', 'line', **{
+            'title': 'Number of sessions by session timeout',
+            'ylabel': 'Number of sessions',
+            'xlabel': 'Timeout (s)',
+        })
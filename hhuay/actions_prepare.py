@@ -1,56 +1,317 @@
 from __future__ import unicode_literals
 
+import collections
+import hashlib
+import heapq
+import io
+import json
+import multiprocessing
 import re
+import time
 
+from .cookies import (
+    parse_cookies,
+    tracking_cookie_digest,
+)
+from .dbhelpers import (
+    BatchInserter,
+    bump_generation,
+    DBConnection,
+)
+from .dimensions import (
+    create_dimension_tables,
+    DimensionValues,
+)
+from .routes import (
+    classify_url,
+    ROUTE_COLUMNS,
+    ROUTE_STATIC,
+    ROUTE_STATS_READ_COMMENTS,
+)
 from .util import (
-    extract_user_from_cookies,
     FileProgress,
+    Option,
     options,
     parse_date,
+    print_throughput,
     sql_filter,
     TableSizeProgressBar,
 )
-from .sources import get_requests_from_db
+from .sources import (
+    get_requests_from_db,
+    get_requests_from_logfiles,
+)
+from . import snapshot
 
-@options([], requires_db=True)
-def action_load_requestlog(args, config, db, wdb):
-    """ Creates analysis_requestlog database table based off requestlog table """
+REQUESTLOG_COLUMNS = (
+    'source_id', 'access_time', 'ip_id', 'url_id', 'cookies',
+    'user_agent_id', 'method', 'tracking_cookie', 'user_sid', 'deleted')
 
-    wdb.drop_table('analysis_requestlog')
-    wdb.execute('''CREATE TABLE analysis_requestlog (
+
+def _create_requestlog_table(wdb, tblname):
+    wdb.recreate_table(tblname, '''
         id int PRIMARY KEY auto_increment,
+        source_id int,
         access_time int,
-        ip_address varchar(255),
-        request_url text,
+        ip_id bigint,
+        url_id bigint,
         cookies text,
-        user_agent text,
+        user_agent_id bigint,
         deleted boolean NOT NULL,
-        method varchar(10));
+        deleted_reasons int NOT NULL DEFAULT 0,
+        method varchar(10),
+        tracking_cookie char(40),
+        user_sid varchar(64),
+        INDEX (source_id),
+        INDEX (deleted_reasons),
+        INDEX (tracking_cookie, access_time),
+        INDEX (user_sid),
+        INDEX (user_agent_id)
     ''')
 
-    # We need a second cursor due to parallel db access
-    cur2 = wdb.db.cursor(buffered=True)
-    
-    for r in get_requests_from_db(db):
-        sql = '''INSERT INTO analysis_requestlog
-            SET access_time = %s,
-                ip_address = %s,
-                request_url = %s,
-                cookies = %s,
-                user_agent = %s,
-                method = '',
-                deleted = 0;
-        '''
-        cur2.execute(
-            sql,
-            (r.time, r.ip, r.path, r.cookies, r.user_agent))
-        
+
+def _requestlog_row(r, dims):
+    parsed = parse_cookies(r.cookies)
+    return (
+        r.source_id, r.time,
+        dims.add('analysis_ip', r.ip),
+        dims.add('analysis_url', r.path),
+        r.cookies,
+        dims.add('analysis_user_agent', r.user_agent),
+        r.method, tracking_cookie_digest(parsed.tracking_cookie),
+        parsed.user_sid, 0)
+
+
+def _import_requestlog_range(task):
+    """ Import the requests with after_id < id <= until_id into tblname.
+        Runs in a worker process with its own database connections. """
+    config, tblname, after_id, until_id, batch_size = task
+    dims = DimensionValues()
+    with DBConnection(config) as db, DBConnection(config) as wdb:
+        with BatchInserter(wdb, tblname, REQUESTLOG_COLUMNS,
+                           batch_size=batch_size) as inserter:
+            requests = get_requests_from_db(
+                db, after_id=after_id, until_id=until_id)
+            for r in requests:
+                inserter.add(_requestlog_row(r, dims))
+        wdb.commit()
+    # The dimension tables are written by the parent process
+    return inserter.count, dims
+
+
+def _split_id_range(after_id, max_id, count):
+    """ Split the ids after_id < id <= max_id into count (after, until)
+        ranges of roughly equal width """
+    step = max(1, -(-(max_id - after_id) // count))
+    return [
+        (lo, min(lo + step, max_id))
+        for lo in range(after_id, max_id, step)]
+
+
+def _import_ranges(config, dims, tblname, after_id, max_id, workers,
+                   batch_size):
+    """ Import the requests with after_id < id <= max_id into tblname with
+        a pool of worker processes, returns the number of rows written """
+
+    # More ranges than workers so that a dense range does not hold up the rest
+    ranges = _split_id_range(after_id, max_id, workers * 4)
+    tasks = [
+        (config, tblname, lo, hi, batch_size) for lo, hi in ranges]
+    pool = multiprocessing.Pool(workers)
+    try:
+        imported = 0
+        for done, (count, range_dims) in enumerate(
+                pool.imap_unordered(_import_requestlog_range, tasks), start=1):
+            imported += count
+            dims.update(range_dims)
+            print('Imported range %d/%d (%d rows so far)' % (
+                done, len(tasks), imported))
+    finally:
+        pool.close()
+        pool.join()
+    return imported
+
+
+def _parallel_import_requestlog(
+        config, wdb, dims, after_id, workers, batch_size):
+    """ Import requestlog with a pool of worker processes into a staging
+        table, then copy it into analysis_requestlog in source order """
+
+    staging = 'analysis_requestlog_import'
+    wdb.execute('SELECT MIN(id), MAX(id) FROM requestlog')
+    min_id, max_id = list(wdb)[0]
+    if max_id is None:
+        return 0
+    if after_id is None:
+        after_id = min_id - 1
+    # Rows appended to requestlog while we import are left for the next run
+    expected = wdb.simple_query(
+        'SELECT COUNT(*) FROM requestlog WHERE id > %s AND id <= %s',
+        (after_id, max_id))[0]
+
+    _create_requestlog_table(wdb, staging)
     wdb.commit()
+    try:
+        imported = _import_ranges(
+            config, dims, staging, after_id, max_id, workers, batch_size)
+        if imported != expected:
+            raise ValueError(
+                'Import incomplete: expected %d rows, workers wrote %d' % (
+                    expected, imported))
+    except BaseException:
+        wdb.drop_table(staging)
+        raise
 
+    wdb.execute('''INSERT INTO analysis_requestlog (%s)
+        SELECT %s FROM %s ORDER BY source_id''' % (
+        ', '.join(REQUESTLOG_COLUMNS), ', '.join(REQUESTLOG_COLUMNS), staging))
+    copied = wdb.affected_rows()
+    if copied != expected:
+        raise ValueError(
+            'Copy incomplete: expected %d rows, copied %d' % (
+                expected, copied))
+    wdb.drop_table(staging)
+    return copied
 
-@options([], requires_db=True)
-def action_cleanup_requestlog(args, config, db, wdb):
-    """ Remove unneeded requests, or ones we created ourselves """
+
+@options([
+    Option(
+        '--batch-size',
+        dest='batch_size',
+        help='Number of rows to write per INSERT statement',
+        type=int,
+        default=1000),
+    Option(
+        '--incremental',
+        dest='incremental',
+        help='Only import requests newer than the ones already imported',
+        action='store_true'),
+    Option(
+        '--workers',
+        dest='workers',
+        help='Import id ranges in this many parallel processes',
+        type=int,
+        default=1),
+], requires_db=True)
+def action_load_requestlog(args, config, db, wdb):
+    """ Creates analysis_requestlog database table based off requestlog table """
+
+    after_id = None
+    if args.incremental and wdb.table_exists('analysis_requestlog'):
+        missing = set(REQUESTLOG_COLUMNS) - set(
+            wdb.column_names('analysis_requestlog'))
+        if missing:
+            raise ValueError(
+                'analysis_requestlog was created by an older version and '
+                'lacks the columns %s. Re-run without --incremental.' %
+                ', '.join(sorted(missing)))
+        # The platform only appends to requestlog, so the highest source id
+        # we imported marks where to continue.
+        after_id = wdb.simple_query(
+            'SELECT MAX(source_id) FROM analysis_requestlog')[0]
+        if after_id is None:
+            after_id = 0
+        print('Importing requests after source id %d' % after_id)
+    else:
+        _create_requestlog_table(wdb, 'analysis_requestlog')
+        create_dimension_tables(wdb)
+
+    start_time = time.time()
+    dims = DimensionValues()
+    if args.workers > 1:
+        count = _parallel_import_requestlog(
+            config, wdb, dims, after_id, args.workers, args.batch_size)
+    else:
+        # Reads go through db, writes through wdb due to parallel db access
+        with BatchInserter(wdb, 'analysis_requestlog', REQUESTLOG_COLUMNS,
+                           batch_size=args.batch_size) as inserter:
+            for r in get_requests_from_db(db, after_id=after_id):
+                inserter.add(_requestlog_row(r, dims))
+        count = inserter.count
+    dims.write(wdb, batch_size=args.batch_size)
+    bump_generation(wdb, 'analysis_requestlog')
+
+    wdb.commit()
+    print_throughput('Loaded', count, start_time)
+
+
+@options([
+    Option(
+        '--batch-size',
+        dest='batch_size',
+        help='Number of rows to write per INSERT statement',
+        type=int,
+        default=1000),
+    Option(
+        '--append',
+        dest='append',
+        help='Add to an existing analysis_requestlog instead of recreating it',
+        action='store_true'),
+], requires_db=True)
+def action_load_logfiles(args, config, db, wdb):
+    """ Creates analysis_requestlog database table from Apache access logs """
+
+    if not args.files:
+        raise ValueError('No log files specified')
+
+    if not (args.append and wdb.table_exists('analysis_requestlog')):
+        _create_requestlog_table(wdb, 'analysis_requestlog')
+        create_dimension_tables(wdb)
+
+    dims = DimensionValues()
+    discardf = None
+    if args.discardfile:
+        discardf = io.open(args.discardfile, 'w', encoding='utf-8')
+    try:
+        start_time = time.time()
+        with BatchInserter(wdb, 'analysis_requestlog', REQUESTLOG_COLUMNS,
+                           batch_size=args.batch_size) as inserter:
+            for r in get_requests_from_logfiles(args.files, discardf):
+                inserter.add(_requestlog_row(r, dims))
+    finally:
+        if discardf is not None:
+            discardf.close()
+    dims.write(wdb, batch_size=args.batch_size)
+    bump_generation(wdb, 'analysis_requestlog')
+
+    wdb.commit()
+    print_throughput('Loaded', inserter.count, start_time)
+
+
+DEFAULT_BOT_USER_AGENTS = [
+    'GoogleBot', 'Pingdom', 'ApacheBench', 'bingbot', 'YandexBot',
+    'SISTRIX Crawler',
+]
+
+CleanupRule = collections.namedtuple(
+    'CleanupRule', ['name', 'description', 'condition', 'params'])
+
+
+# (string column, id column, dimension table) of analysis_requestlog
+_DIMENSION_COLUMNS = [
+    ('ip_address', 'ip_id', 'analysis_ip'),
+    ('request_url', 'url_id', 'analysis_url'),
+    ('user_agent', 'user_agent_id', 'analysis_user_agent'),
+]
+
+
+def _check_extra_rule(name, condition):
+    """ Reject rules written for the old analysis_requestlog, which stored
+        the strings themselves instead of ids into the dimension tables """
+    for column, id_column, table in _DIMENSION_COLUMNS:
+        if (re.search(r'\b%s\b' % column, condition) and
+                not re.search(r'\b%s\b' % table, condition)):
+            raise ValueError(
+                'Cleanup rule %s refers to %s, which is now stored in %s. '
+                'Write the condition as %s IN (SELECT id FROM %s WHERE ...)' %
+                (name, column, table, id_column, table))
+
+
+def get_cleanup_rules(config):
+    """ The rules for deleting rows of analysis_requestlog. Every rule is a
+        SQL condition on the columns of analysis_requestlog. Strings are
+        stored in the dimension tables, so conditions on them are subqueries
+        on the ids. """
 
     try:
         start_date = parse_date(config['startdate'])
@@ -58,124 +319,472 @@ def action_cleanup_requestlog(args, config, db, wdb):
     except KeyError as ke:
         raise KeyError('Missing key %s in configuration' % ke.args[0])
 
+    bots = config.get('cleanup_bot_user_agents', DEFAULT_BOT_USER_AGENTS)
+    rules = [
+        CleanupRule(
+            'date', 'due to date constraints',
+            'access_time < %s OR access_time > %s', (start_date, end_date)),
+        CleanupRule(
+            'user_agent', 'due to UA constraints',
+            '''user_agent_id IN (
+                SELECT id FROM analysis_user_agent WHERE user_agent RLIKE %s)''',
+            ('|'.join(bots),)),
+        CleanupRule(
+            'cookies', 'that do not have cookies',
+            'cookies IS NULL', ()),
+    ]
+    for name, condition in sorted(
+            config.get('cleanup_extra_rules', {}).items()):
+        _check_extra_rule(name, condition)
+        rules.append(CleanupRule(name, 'due to rule %s' % name, condition, ()))
+    # deleted_reasons is a bitmask of the matching rules
+    assert len(rules) <= 31
+    return rules
+
+
+@options([], requires_db=True)
+def action_cleanup_requestlog(args, config, db, wdb):
+    """ Remove unneeded requests, or ones we created ourselves """
+
+    rules = get_cleanup_rules(config)
+
+    # Evaluate all rules in a single pass over the table. Rows flagged by an
+    # earlier run with other rules are updated too, unchanged rows are not
+    # written at all.
+    mask_sql = ' + '.join(
+        '(CASE WHEN (%s) THEN %d ELSE 0 END)' % (r.condition, 1 << i)
+        for i, r in enumerate(rules))
+    params = []
+    for r in rules:
+        params.extend(r.params)
     wdb.execute(
-        '''UPDATE analysis_requestlog SET deleted=1
-            WHERE access_time < %s
-                  OR access_time > %s''',
-        (start_date, end_date))
+        '''UPDATE analysis_requestlog
+            SET deleted_reasons=%s, deleted=((%s) != 0)
+            WHERE deleted_reasons != (%s)''' % (mask_sql, mask_sql, mask_sql),
+        tuple(params) * 3)
     wdb.commit()
-    print('Deleted %d rows due to date constraints' % wdb.affected_rows())
+    print('Updated the deletion flags of %d rows' % wdb.affected_rows())
 
-    wdb.execute(
-        '''UPDATE analysis_requestlog SET deleted=1
-            WHERE user_agent RLIKE
-            'GoogleBot|Pingdom|ApacheBench|bingbot|YandexBot|SISTRIX Crawler';
-    ''')
+    wdb.ensure_index('analysis_requestlog', ['deleted'])
+    wdb.ensure_index('analysis_requestlog', ['access_time'])
     wdb.commit()
-    print('Deleted %d rows due to UA constraints' % wdb.affected_rows())
 
     wdb.execute(
-        '''UPDATE analysis_requestlog SET deleted=1
-            WHERE cookies is NULL;
-    ''')
-    wdb.commit()
-    print('Deleted %d rows that do not have cookies' % wdb.affected_rows())
+        '''SELECT deleted_reasons, COUNT(*) FROM analysis_requestlog
+            WHERE deleted_reasons != 0
+            GROUP BY deleted_reasons''')
+    reason_counts = list(wdb)
+    print('Deleted %d rows in total' % sum(c for _, c in reason_counts))
+    for i, r in enumerate(rules):
+        count = sum(c for mask, c in reason_counts if mask & (1 << i))
+        print('Deleted %d rows %s' % (count, r.description))
+    for mask, count in sorted(reason_counts):
+        matching = [r.name for i, r in enumerate(rules) if mask & (1 << i)]
+        if len(matching) > 1:
+            print('  %d of them match %s' % (count, ' and '.join(matching)))
 
     wdb.execute(
         '''CREATE OR REPLACE VIEW analysis_requestlog_undeleted AS
-            SELECT * FROM analysis_requestlog WHERE NOT deleted''')
+            SELECT analysis_requestlog.*,
+                analysis_ip.ip_address AS ip_address,
+                analysis_url.request_url AS request_url,
+                analysis_user_agent.user_agent AS user_agent
+            FROM analysis_requestlog
+            LEFT JOIN analysis_ip
+                ON analysis_ip.id = analysis_requestlog.ip_id
+            LEFT JOIN analysis_url
+                ON analysis_url.id = analysis_requestlog.url_id
+            LEFT JOIN analysis_user_agent
+                ON analysis_user_agent.id = analysis_requestlog.user_agent_id
+            WHERE NOT analysis_requestlog.deleted''')
+    bump_generation(wdb, 'analysis_requestlog_undeleted')
     wdb.commit()
 
-@options(requires_db=True)
-def action_annotate_requests(args, config, db, wdb):
-    """ Filter out the interesting requests to HTML pages and copy all the
-        information we got with them (for example duration) into one row"""
 
-    bar = TableSizeProgressBar(
-        db, 'analysis_requestlog_undeleted',
-        'Collecting request information')
+ANNOTATION_COLUMNS = (
+    'id', 'request_id', 'user_sid', 'duration', 'detail_json') + ROUTE_COLUMNS
 
-    wdb.recreate_table('analysis_request_annotations', '''
-        id int PRIMARY KEY auto_increment,
+
+def _create_annotations_table(wdb, tblname):
+    # The id is the request id, so the table does not depend on the order
+    # in which requests are written out
+    wdb.recreate_table(tblname, '''
+        id int PRIMARY KEY,
         request_id int,
         user_sid varchar(64),
         duration int,
         detail_json TEXT,
+        route_kind int NOT NULL,
+        instance varchar(255),
+        proposal_id int,
+        sort_order int,
+        link_target text,
         INDEX (request_id),
-        INDEX (user_sid)
+        INDEX (user_sid),
+        INDEX (route_kind, proposal_id)
     ''')
 
-    class RequestInfo(object):
-        __slots__ = 'request_id', 'access_time', 'latest_update', 'user_sid'
 
-        def __init__(self, request_id, access_time, user_sid):
-            self.request_id = request_id
-            self.access_time = access_time
-            self.user_sid = user_sid
-            self.latest_update = None
+class _RequestInfo(object):
+    __slots__ = (
+        'request_id', 'access_time', 'latest_update', 'user_sid',
+        'ping_count', 'read_comments_count', 'route')
 
-        def __str__(self):
-            return '%d %s' % (self.access_time, self.user_sid)
+    def __init__(self, request_id, access_time, user_sid, route):
+        self.request_id = request_id
+        self.access_time = access_time
+        self.user_sid = user_sid
+        self.route = route
+        self.latest_update = None
+        self.ping_count = 0
+        self.read_comments_count = 0
 
-    def write_request(key, ri):
-        ip, user_agent, request_url = key
-        wdb.execute(
-            '''INSERT INTO analysis_request_annotations
-                SET request_id=%s, user_sid=%s
-            ''', (ri.request_id, ri.user_sid))
+    @property
+    def duration(self):
+        if self.latest_update is None:
+            return None
+        return self.latest_update - self.access_time
 
-    # Key: (ip, user_agent, request_url), value: RequestInfo
-    requests = {}
+    @property
+    def detail_json(self):
+        if not self.ping_count and not self.read_comments_count:
+            return None
+        return json.dumps({
+            'pings': self.ping_count,
+            'read_comments': self.read_comments_count,
+        }, sort_keys=True)
 
-    is_stats = re.compile(r'/+(?:i/[^/]+/)?stats/')
-    is_static = re.compile(r'''(?x)
-        /favicon\.ico|
-        /images/|
-        /fanstatic/|
-        /stylesheets/|
-        /robots\.txt|
-        /javascripts|
-        # Technically not static, but very close
-        /admin|
-        /i/[^/]+/instance/[^/]+/settings
-    ''')
+    def __str__(self):
+        return '%d %s' % (self.access_time, self.user_sid)
+
+    @property
+    def last_activity(self):
+        if self.latest_update is None:
+            return self.access_time
+        return self.latest_update
+
+    def annotation_row(self):
+        return (
+            self.request_id, self.request_id, self.user_sid, self.duration,
+            self.detail_json) + self.route[:len(ROUTE_COLUMNS)]
+
+
+AnnotationStats = collections.namedtuple(
+    'AnnotationStats', ['inline', 'evicted', 'max_open', 'at_end'])
+
+
+def _annotate_requests(db, inserter, horizon, ping_timeout, shard=None,
+                       bar=None):
+    """ Annotate the undeleted requests and add the annotations to inserter.
+        A stats ping only counts for a page view that has been active in
+        the last ping_timeout seconds; this is the same condition under
+        which the horizon keeps a request, so a horizon >= ping_timeout
+        does not change the result.
+        With shard=(index, count), only look at the requests whose
+        (ip, user agent) hashes into that shard. Stats pings are only matched
+        with page views of the same IP and user agent, so shards are
+        independent of each other. """
 
+    if horizon is not None and horizon < ping_timeout:
+        raise ValueError(
+            'The horizon (%ds) must not be shorter than the ping timeout '
+            '(%ds)' % (horizon, ping_timeout))
+
+    # Key: (ip_id, user_agent_id, request_url), value: _RequestInfo
+    requests = {}
+    # With a horizon: (last activity, request_id, key) of all requests,
+    # entries of requests that have been replaced or updated are skipped
+    idle_heap = []
+    evict_count = 0
+    max_open = 0
     write_count = 0
-    db.execute(
+
+    where = ''
+    if shard is not None:
+        index, count = shard
+        # The ids are positive hashes, so this spreads keys evenly
+        where = (
+            'WHERE ((COALESCE(ip_id, 0) %% %d) + '
+            '(COALESCE(user_agent_id, 0) %% %d)) %% %d = %d' % (
+                count, count, count, index))
+    # Order ties by id so that every run sees the same order
+    rows = db.stream(
         '''SELECT id, access_time as atime,
-                  ip_address, user_agent, request_url, cookies
+                  ip_id, user_agent_id, request_url, user_sid
             FROM analysis_requestlog_undeleted
-            ORDER BY access_time ASC
-            ''')
-    for req in db:
-        bar.next()
-        request_id, atime, ip, user_agent, request_url, cookies = req
-        if is_static.match(request_url):
+            %s
+            ORDER BY access_time ASC, id ASC
+            ''' % where)
+    for req in rows:
+        if bar is not None:
+            bar.next()
+        request_id, atime, ip_id, user_agent_id, request_url, user = req
+
+        if horizon is not None:
+            while idle_heap and idle_heap[0][0] < atime - horizon:
+                activity, rid, idle_key = heapq.heappop(idle_heap)
+                ri = requests.get(idle_key)
+                if ri is None or ri.request_id != rid:
+                    continue  # Already written out
+                if ri.last_activity > activity:
+                    heapq.heappush(
+                        idle_heap, (ri.last_activity, rid, idle_key))
+                    continue
+                inserter.add(ri.annotation_row())
+                del requests[idle_key]
+                evict_count += 1
+
+        route = classify_url(request_url)
+        if route.kind == ROUTE_STATIC:
             continue  # Skip
-        #assert '/stats' not in request_url
-        key = (ip, user_agent, request_url)
+        if route.page_path is not None:
+            # Attribute stats pings to the page view they were sent from
+            ri = requests.get((ip_id, user_agent_id, route.page_path))
+            if (ri is not None and atime >= ri.access_time and
+                    ri.last_activity >= atime - ping_timeout):
+                ri.latest_update = atime
+                if route.kind == ROUTE_STATS_READ_COMMENTS:
+                    ri.read_comments_count += 1
+                else:
+                    ri.ping_count += 1
+
+        key = (ip_id, user_agent_id, request_url)
         cur = requests.get(key)
         if cur is not None:
-            write_request(key, cur)
+            inserter.add(cur.annotation_row())
             del requests[key]
             write_count += 1
-        user = extract_user_from_cookies(cookies, None)
-        requests[key] = RequestInfo(request_id, atime, user)
-    bar.finish()
+        requests[key] = _RequestInfo(request_id, atime, user, route)
+        if horizon is not None:
+            heapq.heappush(idle_heap, (atime, request_id, key))
+        max_open = max(max_open, len(requests))
+    if bar is not None:
+        bar.finish()
+
+    for ri in requests.values():
+        inserter.add(ri.annotation_row())
+    inserter.flush()
+    return AnnotationStats(write_count, evict_count, max_open, len(requests))
+
+
+def _annotate_shard(task):
+    """ Annotate one shard of the requests into tblname.
+        Runs in a worker process with its own database connections. """
+    config, tblname, shard, horizon, ping_timeout, batch_size = task
+    with DBConnection(config) as db, DBConnection(config) as wdb:
+        inserter = BatchInserter(
+            wdb, tblname, ANNOTATION_COLUMNS, batch_size=batch_size)
+        stats = _annotate_requests(
+            db, inserter, horizon, ping_timeout, shard=shard)
+        wdb.commit()
+    return inserter.count, stats
+
+
+def _parallel_annotate_requests(config, tblname, workers, horizon,
+                                ping_timeout, batch_size):
+    """ Annotate with one worker process per shard, returns the number of
+        annotations and the AnnotationStats of the shards """
+
+    tasks = [
+        (config, tblname, (index, workers), horizon, ping_timeout,
+         batch_size)
+        for index in range(workers)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        count = 0
+        all_stats = []
+        for done, (shard_count, stats) in enumerate(
+                pool.imap_unordered(_annotate_shard, tasks), start=1):
+            count += shard_count
+            all_stats.append(stats)
+            print('Annotated shard %d/%d (%d rows so far)' % (
+                done, len(tasks), count))
+    finally:
+        pool.close()
+        pool.join()
+    return count, all_stats
+
 
-    print('Writing out %d requests (already wrote out %d inline) ...' % (
-        len(requests), write_count))
-    for key, ri in requests.items():
-        write_request(key, ri)
+def table_digest(db, tblname, columns):
+    """ SHA1 of the contents of tblname, ordered by id """
+    assert re.match(r'^[a-zA-Z_0-9]+$', tblname)
+    h = hashlib.sha1()
+    rows = db.stream('SELECT %s FROM %s ORDER BY id' % (
+        ', '.join(columns), tblname))
+    for row in rows:
+        h.update(repr(tuple(row)).encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
 
-    wdb.execute('''CREATE OR REPLACE VIEW analysis_requestlog_combined AS
-        SELECT analysis_requestlog_undeleted.*,
-            analysis_request_annotations.user_sid as user_sid,
+
+@options([
+    Option(
+        '--batch-size',
+        dest='batch_size',
+        help='Number of rows to write per INSERT statement',
+        type=int,
+        default=5000),
+    Option(
+        '--horizon',
+        dest='horizon',
+        help='Write out and forget requests idle for this many seconds '
+             '(default: keep all requests until the end)',
+        type=int,
+        default=None),
+    Option(
+        '--ping-timeout',
+        dest='ping_timeout',
+        help='Ignore stats pings for page views that have been idle for more '
+             'than this many seconds',
+        type=int,
+        default=600),
+    Option(
+        '--materialize',
+        dest='materialize',
+        help='Create analysis_requestlog_combined as an indexed table '
+             'instead of a view (see refresh_requestlog_combined)',
+        action='store_true'),
+    Option(
+        '--workers',
+        dest='workers',
+        help='Annotate shards of the requests in this many parallel '
+             'processes',
+        type=int,
+        default=1),
+    Option(
+        '--verify',
+        dest='verify',
+        help='With --workers, also annotate sequentially and check that '
+             'the results are identical',
+        action='store_true'),
+], requires_db=True)
+def action_annotate_requests(args, config, db, wdb):
+    """ Filter out the interesting requests to HTML pages and copy all the
+        information we got with them (for example duration) into one row"""
+
+    _create_annotations_table(wdb, 'analysis_request_annotations')
+    wdb.commit()
+
+    start_time = time.time()
+    if args.workers > 1:
+        count, all_stats = _parallel_annotate_requests(
+            config, 'analysis_request_annotations', args.workers,
+            args.horizon, args.ping_timeout, args.batch_size)
+        stats = AnnotationStats(
+            sum(st.inline for st in all_stats),
+            sum(st.evicted for st in all_stats),
+            max(st.max_open for st in all_stats),
+            sum(st.at_end for st in all_stats))
+    else:
+        bar = TableSizeProgressBar(
+            db, 'analysis_requestlog_undeleted',
+            'Collecting request information')
+        inserter = BatchInserter(
+            wdb, 'analysis_request_annotations', ANNOTATION_COLUMNS,
+            batch_size=args.batch_size)
+        stats = _annotate_requests(
+            db, inserter, args.horizon, args.ping_timeout, bar=bar)
+        count = inserter.count
+    bump_generation(wdb, 'analysis_request_annotations')
+    wdb.commit()
+
+    print('Wrote out %d requests at the end (%d inline)' % (
+        stats.at_end, stats.inline + stats.evicted))
+    if args.horizon is not None:
+        print('%d requests were written out after being idle for %ds, '
+              'at most %d requests were kept in memory' % (
+                  stats.evicted, args.horizon, stats.max_open))
+    print_throughput('Annotated', count, start_time)
+
+    if args.verify and args.workers > 1:
+        verify_tbl = 'analysis_request_annotations_verify'
+        _create_annotations_table(wdb, verify_tbl)
+        inserter = BatchInserter(
+            wdb, verify_tbl, ANNOTATION_COLUMNS, batch_size=args.batch_size)
+        _annotate_requests(db, inserter, args.horizon, args.ping_timeout)
+        wdb.commit()
+        expected = table_digest(db, verify_tbl, ANNOTATION_COLUMNS)
+        got = table_digest(
+            db, 'analysis_request_annotations', ANNOTATION_COLUMNS)
+        wdb.drop_table(verify_tbl)
+        if got != expected:
+            raise ValueError(
+                'Parallel annotation differs from the sequential one '
+                '(digest %s, expected %s)' % (got, expected))
+        print('Verified: identical to the sequential run (%s)' % got)
+
+    create_requestlog_combined(wdb, args.materialize)
+
+
+COMBINED_INDEXES = [
+    ['id'],
+    ['access_time'],
+    ['user_sid'],
+    ['user_agent_id'],
+]
+
+
+def create_requestlog_combined(wdb, materialize):
+    """ (Re)create analysis_requestlog_combined, either as a view or as a
+        table with a copy of the rows """
+
+    select_sql = '''SELECT analysis_requestlog_undeleted.*,
             analysis_request_annotations.duration as duration,
-            analysis_request_annotations.detail_json as detail_json
+            analysis_request_annotations.detail_json as detail_json,
+            analysis_request_annotations.route_kind as route_kind,
+            analysis_request_annotations.instance as instance,
+            analysis_request_annotations.proposal_id as proposal_id,
+            analysis_request_annotations.sort_order as sort_order,
+            analysis_request_annotations.link_target as link_target
         FROM analysis_requestlog_undeleted, analysis_request_annotations
         WHERE analysis_requestlog_undeleted.id = analysis_request_annotations.request_id
-    ''')
+    '''
+    wdb.drop_table_or_view('analysis_requestlog_combined')
+    if not materialize:
+        wdb.execute(
+            'CREATE OR REPLACE VIEW analysis_requestlog_combined AS ' +
+            select_sql)
+        bump_generation(wdb, 'analysis_requestlog_combined')
+        wdb.commit()
+        return
+
+    start_time = time.time()
+    wdb.execute(
+        'CREATE TABLE analysis_requestlog_combined AS ' + select_sql)
+    for columns in COMBINED_INDEXES:
+        wdb.ensure_index('analysis_requestlog_combined', columns)
+    bump_generation(wdb, 'analysis_requestlog_combined')
+    wdb.commit()
+    count = wdb.simple_query(
+        'SELECT COUNT(*) FROM analysis_requestlog_combined')[0]
+    print_throughput('Materialized', count, start_time)
+
+
+@options([
+    Option(
+        '--materialize',
+        dest='materialize',
+        help='Store a copy of the rows in a table instead of a view',
+        action='store_true'),
+], requires_db=True)
+def action_refresh_requestlog_combined(args, config, db, wdb):
+    """ Recreate analysis_requestlog_combined from the current contents of
+        analysis_requestlog and analysis_request_annotations """
+
+    create_requestlog_combined(wdb, args.materialize)
+
+
+@options(requires_db=True)
+def action_snapshot_requestlog(args, config, db, wdb):
+    """ Dump analysis_requestlog_combined into a local columnar snapshot """
+
+    bar = TableSizeProgressBar(
+        db, 'analysis_requestlog_combined', 'Writing snapshot')
+    start_time = time.time()
+    count = snapshot.write_snapshot(db, bar=bar)
+    bar.finish()
+    print_throughput('Wrote snapshot of', count, start_time)
+
 
 @options()
 def action_user_classification(args, config, db, wdb):
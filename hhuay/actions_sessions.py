@@ -1,7 +1,17 @@
 from __future__ import unicode_literals
 
+import array
 import collections
+import hashlib
+import heapq
+import itertools
+import random
+import time
 
+from .dbhelpers import (
+    BatchInserter,
+    bump_generation,
+)
 from .util import (
     options,
     Option,
@@ -11,101 +21,303 @@ from .util import (
 )
 
 
-@options([
-    Option(
-        '--timeout',
-        dest='timeout',
-        help='Timeout in seconds',
-        type=int,
-        default=60 * 60)
-], requires_db=True)
-def action_assign_requestlog_sessions(args, config, db, wdb):
-    bar = TableSizeProgressBar(
-        db, 'analysis_requestlog_undeleted', 'Assigning sessions')
+class _Session(object):
+    __slots__ = (
+        'tracking_cookie', 'requests', 'time', 'first_time', 'seq',
+        'session_id')
 
-    wdb.recreate_table('analysis_session', '''
-        id int PRIMARY KEY auto_increment,
-        tracking_cookie text,
-        first_update_timestamp int,
-        last_update_timestamp int
-    ''')
+    def __init__(self, seq, session_id=None):
+        self.tracking_cookie = None
+        self.requests = []
+        self.time = None
+        self.first_time = None
+        self.seq = seq
+        # Only set for sessions that are already in the database
+        self.session_id = session_id
 
-    wdb.recreate_table('analysis_session_requests', '''
-        session_id int,
-        request_id int
-    ''')
+    def result(self):
+        return (
+            self.session_id, self.tracking_cookie, self.first_time,
+            self.time, self.requests)
 
-    def get_session(cookies):
-        tokens = cookies.split(';')
-        for token in tokens:
-            if token.find('user_tracking') != -1:
-                _,tracking = token.split('=',1)
-                return tracking
-        return None;
-        
-    def write_session(s):
-        wdb.execute(
-            '''INSERT INTO analysis_session
-                SET last_update_timestamp=%s,
-                first_update_timestamp=%s,
-                tracking_cookie=%s''', (s.time, s.first_time, s.tracking_cookie))
-        session_id = wdb.lastrowid
-        assert session_id is not None
-        wdb.executemany(
-            '''INSERT INTO analysis_session_requests
-                SET session_id=%s, request_id=%s''',
-            [(session_id, rid) for rid in s.requests])
-        return session_id
 
-    class Session(object):
-        __slots__ = 'tracking_cookie', 'requests', 'time', 'first_time'
-
-        def __init__(self):
-            self.tracking_cookie = None
-            self.requests = []
-            self.time = None
-            self.first_time = None
-
-    db.execute(
-        '''SELECT
-                id,
-                access_time,
-                ip_address,
-                user_agent,
-                cookies
-            FROM analysis_requestlog_undeleted ORDER BY access_time ASC''')
+def _sessionize_loop(rows, timeout, by_cookie, stats, bar=None,
+                     open_sessions=()):
+    """ Yield (session_id, tracking_cookie, first_time, last_time,
+        request_ids) of the sessions in rows of (id, access_time,
+        tracking_cookie), which are ordered by time (or by cookie and time
+        with by_cookie). The session_id is None for new sessions.
+        open_sessions are (session_id, tracking_cookie, first_time,
+        last_time) of earlier sessions that the requests can continue;
+        they are yielded with the new requests only. """
 
-    nPos = 0
-    nNeg = 0
+    session_seqs = itertools.count()
     # sessions key is the apache cookie
-    # sessions value is a python tuple of (request_id, time, first_time)
-    sessions = collections.defaultdict(Session)
-    for idx, req in enumerate(db):
-        bar.next()
-        request_id, atime, ip, ua, cookies = req
+    sessions = collections.defaultdict(lambda: _Session(next(session_seqs)))
+    # Without by_cookie: (last request time, seq, key) of the open
+    # sessions, so that sessions can be written out as soon as they timed
+    # out. Entries of sessions that got another request since are pushed
+    # again with the new time.
+    idle_heap = []
+    for session_id, key, first_time, last_time in open_sessions:
+        s = sessions[key] = _Session(next(session_seqs), session_id)
+        s.tracking_cookie = key
+        s.first_time = first_time
+        s.time = last_time
+        if not by_cookie:
+            heapq.heappush(idle_heap, (last_time, s.seq, key))
+    prev_key = None
+    for req in rows:
+        if bar is not None:
+            bar.next()
+        request_id, atime, key = req
         assert atime != 0
-        key = get_session(cookies)
+        while idle_heap and idle_heap[0][0] + timeout < atime:
+            last_time, seq, idle_key = heapq.heappop(idle_heap)
+            s = sessions.get(idle_key)
+            if s is None or s.seq != seq:
+                continue  # Already written out
+            if s.time > last_time:
+                heapq.heappush(idle_heap, (s.time, seq, idle_key))
+                continue
+            yield s.result()
+            del sessions[idle_key]
+            stats['evicted'] += 1
         if key==None:
-            nNeg += 1
+            stats['without_cookie'] += 1
             continue # skip requests without tracking cookie
         else:
-            nPos += 1
+            stats['with_cookie'] += 1
+            if by_cookie and prev_key is not None and key != prev_key:
+                # All requests with the previous cookie have been read
+                s = sessions.pop(prev_key)
+                yield s.result()
+            prev_key = key
             s = sessions[key]
             if s.first_time is None:
                 s.first_time = atime
                 s.tracking_cookie = key
-            if s.time is not None and s.time + args.timeout < atime:
+            if s.time is not None and s.time + timeout < atime:
                 # timeout: write old session to DB and setup new session
-                last_id = write_session(s)
+                yield s.result()
                 del sessions[key]
                 s = sessions[key]
                 s.first_time = atime
                 s.tracking_cookie = key
+            if not by_cookie and s.time is None:
+                heapq.heappush(idle_heap, (atime, s.seq, key))
             s.requests.append(request_id)
             s.time = atime
-    
+            stats['max_open'] = max(stats['max_open'], len(sessions))
+
     for s in sessions.values():
-        last_id = write_session(s)
+        yield s.result()
+
+
+def _sessionize_numpy(rows, timeout, stats, bar=None):
+    """ Like _sessionize_loop, but find the session boundaries with NumPy.
+        rows can be in any order; sessions are yielded by start time. """
+    import numpy as np
+
+    ids = array.array('q')
+    times = array.array('q')
+    cookie_codes = array.array('q')
+    cookie_dict = {}
+    cookies = []
+    for request_id, atime, key in rows:
+        if bar is not None:
+            bar.next()
+        assert atime != 0
+        if key is None:
+            stats['without_cookie'] += 1
+            continue # skip requests without tracking cookie
+        code = cookie_dict.get(key)
+        if code is None:
+            code = cookie_dict[key] = len(cookies)
+            cookies.append(key)
+        ids.append(request_id)
+        times.append(atime)
+        cookie_codes.append(code)
+    stats['with_cookie'] += len(ids)
+    if not ids:
+        return
+
+    ids = np.frombuffer(ids, dtype=np.int64)
+    times = np.frombuffer(times, dtype=np.int64)
+    cookie_codes = np.frombuffer(cookie_codes, dtype=np.int64)
+
+    order = np.lexsort((ids, times, cookie_codes))
+    ids = ids[order]
+    times = times[order]
+    cookie_codes = cookie_codes[order]
+
+    # A session starts with the first request of a cookie and after every
+    # gap longer than the timeout
+    is_start = np.ones(len(ids), dtype=bool)
+    is_start[1:] = (
+        (cookie_codes[1:] != cookie_codes[:-1]) |
+        (times[1:] - times[:-1] > timeout))
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(ids))
+
+    first_times = times[starts]
+    last_times = times[ends - 1]
+    session_order = np.argsort(first_times, kind='stable')
+    for idx in session_order.tolist():
+        start = int(starts[idx])
+        end = int(ends[idx])
+        yield (
+            None, cookies[int(cookie_codes[start])], int(first_times[idx]),
+            int(last_times[idx]), ids[start:end].tolist())
+
+
+def _read_session_rows(db, engine, by_cookie, after_time=None):
+    """ The requests with access_time >= after_time (if given) """
+    if engine == 'numpy':
+        order = ''
+    elif by_cookie:
+        order = 'ORDER BY tracking_cookie ASC, access_time ASC, id ASC'
+    else:
+        order = 'ORDER BY access_time ASC'
+    if after_time is None:
+        where = ''
+        params = None
+    else:
+        where = 'WHERE access_time >= %s '
+        params = (after_time,)
+    return db.stream(
+        '''SELECT
+                id,
+                access_time,
+                tracking_cookie
+            FROM analysis_requestlog_undeleted ''' + where + order, params)
+
+
+@options([
+    Option(
+        '--timeout',
+        dest='timeout',
+        help='Timeout in seconds',
+        type=int,
+        default=60 * 60),
+    Option(
+        '--by-cookie',
+        dest='by_cookie',
+        help='Read requests ordered by tracking cookie, so that only one '
+             'session has to be kept in memory',
+        action='store_true'),
+    Option(
+        '--batch-size',
+        dest='batch_size',
+        help='Number of rows to write per INSERT statement',
+        type=int,
+        default=5000),
+    Option(
+        '--engine',
+        dest='engine',
+        help='loop: look at one request after the other (default), '
+             'numpy: load all requests into arrays and split them into '
+             'sessions in one go (faster, needs more memory)',
+        choices=['loop', 'numpy'],
+        default='loop'),
+    Option(
+        '--incremental',
+        dest='incremental',
+        help='Only assign requests from the last assigned second on, '
+             'continuing sessions that were still open then. Use the same '
+             'timeout as in the earlier runs.',
+        action='store_true'),
+], requires_db=True)
+def action_assign_requestlog_sessions(args, config, db, wdb):
+    if args.incremental and args.engine != 'loop':
+        raise ValueError('--incremental is only supported by the loop engine')
+
+    bar = TableSizeProgressBar(
+        db, 'analysis_requestlog_undeleted', 'Assigning sessions')
+
+    after_time = None
+    open_sessions = []
+    assigned = frozenset()
+    if (args.incremental and wdb.table_exists('analysis_session') and
+            wdb.table_exists('analysis_session_requests')):
+        wdb.execute('SELECT MAX(id), MAX(last_update_timestamp) '
+                    'FROM analysis_session')
+        max_id, after_time = list(wdb)[0]
+    if after_time is None:
+        max_id = 0
+        wdb.recreate_table('analysis_session', '''
+            id int PRIMARY KEY auto_increment,
+            tracking_cookie text,
+            first_update_timestamp int,
+            last_update_timestamp int
+        ''')
+
+        wdb.recreate_table('analysis_session_requests', '''
+            session_id int,
+            request_id int
+        ''')
+    else:
+        print('Assigning requests from %d on' % after_time)
+        # Only the latest session of a cookie can still be open
+        wdb.execute(
+            '''SELECT id, tracking_cookie, first_update_timestamp,
+                    last_update_timestamp
+                FROM analysis_session
+                WHERE last_update_timestamp >= %s''',
+            (after_time - args.timeout,))
+        open_sessions = list(wdb)
+        # Requests in the last assigned second may already be assigned
+        assigned = frozenset(wdb.simple_query(
+            '''SELECT analysis_session_requests.request_id
+                FROM analysis_session, analysis_session_requests
+                WHERE analysis_session.id = analysis_session_requests.session_id
+                    AND analysis_session.last_update_timestamp = %s''',
+            (after_time,)))
+    wdb.ensure_index('analysis_session_requests', ['session_id'])
+    wdb.ensure_index('analysis_session_requests', ['request_id'])
+    wdb.ensure_index('analysis_session', ['last_update_timestamp'])
+
+    # Session ids are assigned here, so that sessions can be written in
+    # batches instead of asking the database for every new id
+    session_inserter = BatchInserter(
+        wdb, 'analysis_session',
+        ('id', 'last_update_timestamp', 'first_update_timestamp',
+         'tracking_cookie'),
+        batch_size=args.batch_size)
+    request_inserter = BatchInserter(
+        wdb, 'analysis_session_requests', ('session_id', 'request_id'),
+        batch_size=args.batch_size)
+    session_ids = itertools.count(max_id + 1)
+    # (last_update_timestamp, id) of continued sessions
+    updates = []
+
+    stats = collections.Counter()
+    rows = _read_session_rows(db, args.engine, args.by_cookie, after_time)
+    if assigned:
+        rows = (row for row in rows if row[0] not in assigned)
+    if args.engine == 'numpy':
+        sessions = _sessionize_numpy(rows, args.timeout, stats, bar=bar)
+    else:
+        sessions = _sessionize_loop(
+            rows, args.timeout, args.by_cookie, stats, bar=bar,
+            open_sessions=open_sessions)
+    for session_id, tracking_cookie, first_time, last_time, requests in \
+            sessions:
+        if session_id is None:
+            session_id = next(session_ids)
+            session_inserter.add(
+                (session_id, last_time, first_time, tracking_cookie))
+        elif requests:
+            updates.append((last_time, session_id))
+        for rid in requests:
+            request_inserter.add((session_id, rid))
+    session_inserter.flush()
+    request_inserter.flush()
+    for idx in range(0, len(updates), args.batch_size):
+        wdb.executemany(
+            '''UPDATE analysis_session SET last_update_timestamp = %s
+                WHERE id = %s''',
+            updates[idx:idx + args.batch_size])
 
     # How long was each session (at least)?
     wdb.execute('''CREATE OR REPLACE VIEW analysis_session_length AS (
@@ -114,16 +326,210 @@ def action_assign_requestlog_sessions(args, config, db, wdb):
             (last_update_timestamp - first_update_timestamp) AS session_length
         FROM analysis_session
     );''')
+    bump_generation(
+        wdb, 'analysis_session', 'analysis_session_requests',
+        'analysis_session_length')
     wdb.commit()
 
     print(
         '\nAssigned %d sessions (timeout: %d)' %
-        (last_id, args.timeout))
+        (session_inserter.count, args.timeout))
+    if after_time is not None:
+        print('Continued %d sessions' % len(updates))
+    if args.engine == 'loop' and not args.by_cookie:
+        print('%d sessions were written out as soon as they timed out, '
+              'at most %d sessions were kept in memory' % (
+                  stats['evicted'], stats['max_open']))
         
+    nNeg = stats['without_cookie']
+    nPos = stats['with_cookie']
+    if not nNeg + nPos:
+        return
     percentNoCookie = 100 * nNeg/(nNeg+nPos)
     print('Number of requests without tracking cookie: %d (%f%%)' % (nNeg, percentNoCookie))
 
 
+def _synthetic_requests(count, seed=42):
+    """ Yield count time-ordered (id, access_time, tracking_cookie) rows.
+        A window of 200 cookies slides over the log, so each cookie is
+        active for a while; one in 20 requests has no cookie. """
+    rnd = random.Random(seed)
+    atime = 1400000000
+    for request_id in range(1, count + 1):
+        atime += rnd.randint(0, 2)
+        if rnd.random() < 0.05:
+            cookie = None
+        else:
+            cookie = 'c%d' % (request_id // 500 + rnd.randrange(200))
+        yield (request_id, atime, cookie)
+
+
+def _sessions_digest(sessions):
+    """ Order-independent digest of the sessions, returns (count, digest) """
+    digests = sorted(
+        hashlib.sha1(repr((cookie, first, last, sorted(requests))).encode(
+            'utf-8')).digest()
+        for _, cookie, first, last, requests in sessions)
+    return len(digests), hashlib.sha1(b''.join(digests)).hexdigest()
+
+
+@options([
+    Option(
+        '--requests',
+        dest='requests',
+        help='Number of synthetic requests',
+        type=int,
+        default=10000000),
+    Option(
+        '--timeout',
+        dest='timeout',
+        help='Timeout in seconds',
+        type=int,
+        default=600),
+], requires_db=False)
+def action_sessionize_benchmark(args):
+    """ Compare the sessionization engines on a synthetic request log """
+
+    start = time.time()
+    for _ in _synthetic_requests(args.requests):
+        pass
+    generate_time = time.time() - start
+    print('Generating %d requests: %.1fs (included below)' % (
+        args.requests, generate_time))
+
+    results = {}
+    for engine in ('loop', 'numpy'):
+        stats = collections.Counter()
+        rows = _synthetic_requests(args.requests)
+        start = time.time()
+        if engine == 'numpy':
+            sessions = _sessionize_numpy(rows, args.timeout, stats)
+        else:
+            sessions = _sessionize_loop(rows, args.timeout, False, stats)
+        sessions = list(sessions)
+        duration = time.time() - start
+        count, digest = _sessions_digest(sessions)
+        del sessions
+        results[engine] = (count, digest)
+        print('%-5s: %d sessions in %.1fs (%.1fs without generating)' % (
+            engine, count, duration, duration - generate_time))
+
+    if results['loop'] != results['numpy']:
+        raise ValueError('The engines found different sessions: %r' % (
+            results,))
+    print('Both engines found the same sessions')
+
+
+def _timeout_list(value):
+    return sorted(set(int(v) for v in value.split(',') if v.strip()))
+
+
+def _counter_percentiles(counter, percentiles):
+    """ The given percentiles (0-100) of the values counted in counter """
+    total = sum(counter.values())
+    res = {}
+    if not total:
+        return res
+    todo = sorted(percentiles)
+    seen = 0
+    for value, count in sorted(counter.items()):
+        seen += count
+        while todo and seen * 100 >= todo[0] * total:
+            res[todo.pop(0)] = value
+        if not todo:
+            break
+    return res
+
+
+@options([
+    Option(
+        '--timeouts',
+        dest='timeouts',
+        help='Comma-separated session timeouts in seconds',
+        type=_timeout_list,
+        default='60,300,600,900,1200,1800,2700,3600,7200'),
+], requires_db=True)
+def action_session_timeout_sweep(args, config, db, wdb):
+    """ Number and length of sessions for many timeouts, in one pass """
+
+    bar = TableSizeProgressBar(
+        db, 'analysis_requestlog_undeleted', 'Sweeping session timeouts')
+
+    timeouts = args.timeouts
+    # By timeout: Counter of session lengths / request counts per session
+    lengths = dict((t, collections.Counter()) for t in timeouts)
+    request_counts = dict((t, collections.Counter()) for t in timeouts)
+
+    def add_cookie(times):
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        for t in timeouts:
+            length = 0
+            count = 1
+            for gap in gaps:
+                if gap > t:
+                    # Same rule as in assign_requestlog_sessions
+                    lengths[t][length] += 1
+                    request_counts[t][count] += 1
+                    length = 0
+                    count = 1
+                else:
+                    length += gap
+                    count += 1
+            lengths[t][length] += 1
+            request_counts[t][count] += 1
+
+    rows = db.stream(
+        '''SELECT tracking_cookie, access_time
+            FROM analysis_requestlog_undeleted
+            WHERE tracking_cookie IS NOT NULL
+            ORDER BY tracking_cookie ASC, access_time ASC, id ASC''')
+    prev_key = None
+    times = []
+    for key, atime in rows:
+        bar.next()
+        if key != prev_key:
+            if times:
+                add_cookie(times)
+            prev_key = key
+            times = []
+        times.append(atime)
+    if times:
+        add_cookie(times)
+    bar.finish()
+
+    percentiles = [50, 75, 90, 99]
+    res = []
+    print('\n%7s %9s %9s %9s %9s %9s' % (
+        'timeout', 'sessions', 'req/sess', 'mean len', 'median', 'p90'))
+    for t in timeouts:
+        session_count = sum(lengths[t].values())
+        request_count = sum(c * n for c, n in request_counts[t].items())
+        total_length = sum(l * n for l, n in lengths[t].items())
+        length_percentiles = _counter_percentiles(lengths[t], percentiles)
+        mean_length = total_length / session_count if session_count else 0
+        requests_per_session = (
+            request_count / session_count if session_count else 0)
+        res.append({
+            'timeout': t,
+            'sessions': session_count,
+            'requests_per_session': requests_per_session,
+            'length_mean': mean_length,
+            'length_percentiles': dict(
+                ('%d' % p, v) for p, v in length_percentiles.items()),
+            'requests_percentiles': dict(
+                ('%d' % p, v) for p, v in _counter_percentiles(
+                    request_counts[t], percentiles).items()),
+        })
+        print('%7d %9d %9.2f %9.1f %9s %9s' % (
+            t, session_count, requests_per_session, mean_length,
+            length_percentiles.get(50), length_percentiles.get(90)))
+
+    write_data('session_timeout_sweep', {
+        'data': [[r['timeout'], r['sessions']] for r in res],
+        'timeouts': res,
+    })
+
+
 @options([], requires_db=True)
 def action_session_user_stats(args, config, db, wdb):
     """ Calculate some simple statistics about users of sessions """
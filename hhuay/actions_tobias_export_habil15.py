@@ -6,7 +6,6 @@ import itertools
 import json
 import pickle
 import os.path
-import re
 import time
 
 from .dbhelpers import (
@@ -19,17 +18,32 @@ from .util import (
     Option,
     TableSizeProgressBar,
 )
+from .routes import (
+    add_proposal_views,
+    PROPOSAL_VIEW_KINDS,
+    route_from_row,
+    ROUTE_COLUMNS,
+    ROUTE_LOGIN_FAILURE,
+    ROUTE_OUTGOING_LINK,
+    ROUTE_RATE,
+    STATS_KINDS,
+)
 from . import xlsx
 
 SORTORDER_MAP = {
-    '1': '-create_time',
-    '2': 'order.title',
-    '3': '-order.proposal.controversy',
-    '4': '-order.proposal.mixed',
-    '5': '-order.newestcomment',
-    '6': '-order.proposal.support',
+    1: '-create_time',
+    2: 'order.title',
+    3: '-order.proposal.controversy',
+    4: '-order.proposal.mixed',
+    5: '-order.newestcomment',
+    6: '-order.proposal.support',
 }
 
+# (instance, outgoing link target) of the external link to the regulations
+KNOWLEDGE_BASE_LINK = (
+    'grundsaetze',
+    '824893fea3ed4bc0c9789e8d2fd6eb6b8f7c1ab635ec800a1edfff4f740bf837!aHR0cDovL3d3dy5waGlsby5oaHUuZGUvYWthZGVtaXNjaGUtcXVhbGlmaXppZXJ1bmcvaGFiaWxpdGF0aW9uLmh0bWw=')
+
 User = collections.namedtuple(
     'User',
     ['id', 'email', 'textid', 'name', 'gender', 'badges', 'proposal_sort_order'])
@@ -73,25 +87,6 @@ class IPAnonymizer(object):
         self._all_values.add(s)
         return s
 
-proposal_rex = re.compile(r'''(?x)^
-    (?:
-        (?P<is_stats>
-            (?:/i/[a-z]+)?
-            /stats/on_page\?
-            page=https%3A%2F%2Fnormsetzung.cs.uni-duesseldorf.de%2Fi%2F[a-z]+%2Fproposal%2F
-        )|
-        /i/[a-z]+/proposal/
-    )
-    (?P<proposal_id>[0-9]+)
-    -.*
-''')
-
-read_comments_rex = re.compile(r'''(?x)
-    (?:/i/[a-z]+)?/stats/read_comments\?
-    path=.*?%2Fproposal%2F(?P<proposal_id>[0-9]+)-
-''')
-
-
 class ViewStats(object):
     __slots__ = (
         'request_timestamps',
@@ -125,26 +120,7 @@ class ViewStats(object):
 def calc_view_stats(session, db):
     by_proposal = collections.defaultdict(ViewStats)
     
-    for r in session.requests:
-        # Comments read in this request?
-        m = read_comments_rex.match(r.request_url)
-        if m:
-            proposal_id = int(m.group('proposal_id'))
-            vdata = by_proposal[proposal_id]
-            if not vdata.request_timestamps:
-                vdata.request_timestamps.append(r.access_time)
-            #print('Counting %r' % (r,))
-            vdata.read_comments_count += 1
-
-        # Update session duration
-        m = proposal_rex.match(r.request_url)
-        if m:
-            proposal_id = int(m.group('proposal_id'))
-            vdata = by_proposal[proposal_id]
-            if not m.group('is_stats') or not vdata.request_timestamps:
-                vdata.request_timestamps.append(r.access_time)
-            vdata.duration = max(
-                vdata.duration, r.access_time - vdata.request_timestamps[0])
+    add_proposal_views(by_proposal, session.requests)
         
     # Calculate proposal based variables
     for proposal_id in by_proposal:
@@ -332,14 +308,9 @@ def calc_view_stats(session, db):
 def _is_external(ip):
     return not (ip.startswith('134.99.') or ip.startswith('134.94.'))
 
-def _request_counter(rex):
-    re_obj = re.compile(rex)
-
+def _request_counter(predicate):
     def count(session):
-        return sum(
-            1 for r in session.requests
-            if '/stats/' not in r.request_url and
-               re_obj.match(r.request_url) is not None)
+        return sum(1 for r in session.requests if predicate(r.route))
 
     return count
 
@@ -541,7 +512,7 @@ class Session(object):
         self.end_time = None
 Request = collections.namedtuple('Request', [
     'id', 'ip', 'access_time', 'request_url', 'cookies', 'user_agent',
-    'method'])
+    'method', 'duration', 'detail_json', 'route'])
 
 def _is_admin(s, user_dict):
     if s.user_name == 'admin':
@@ -602,14 +573,17 @@ def read_sessions(db, config, user_dict):
         request_ids = db.simple_query('SELECT request_id FROM analysis_session_requests WHERE session_id=%d' % s.session_id )
         
         for request_id in request_ids:
-            db.execute('''SELECT access_time, ip_address, request_url, cookies, user_agent, method
+            db.execute('''SELECT access_time, ip_address, request_url, cookies, user_agent, method, duration, detail_json, %s
             FROM analysis_requestlog_undeleted
-            WHERE id=%d
+            LEFT JOIN analysis_request_annotations
+                ON analysis_request_annotations.id = analysis_requestlog_undeleted.id
+            WHERE analysis_requestlog_undeleted.id=%d
             ORDER BY access_time ASC
-        ;''' % request_id )
+        ;''' % (', '.join(ROUTE_COLUMNS), request_id))
             for row in db:
-                (access_time, ip_address, request_url, cookies, user_agent, method) = row
-                s.requests.append(Request(request_id, ip_address, access_time, request_url, cookies, user_agent, method))
+                (access_time, ip_address, request_url, cookies, user_agent, method, duration, detail_json) = row[:8]
+                route = route_from_row(request_url, row[8:])
+                s.requests.append(Request(request_id, ip_address, access_time, request_url, cookies, user_agent, method, duration, detail_json, route))
     
     # Remove sessions associated with admin
     print('\nsessions total: %d' % len(sessions))
@@ -670,11 +644,11 @@ def export_sessions(args, ws, db, config):
     
     ws.write_header(headers)
 
-    login_failures = _request_counter(r'/+post_login\?_login_tries=0')
-    navigation_count = _request_counter(r'/')
-    vote_count = _request_counter(r'/.*/rate\.')
-    proposal_sort_order_re = re.compile(r'&proposals_sort=([0-9]+)')
-    access_knowledge_base_rex = re.compile(r'/i/grundsaetze/outgoing_link/824893fea3ed4bc0c9789e8d2fd6eb6b8f7c1ab635ec800a1edfff4f740bf837!aHR0cDovL3d3dy5waGlsby5oaHUuZGUvYWthZGVtaXNjaGUtcXVhbGlmaXppZXJ1bmcvaGFiaWxpdGF0aW9uLmh0bWw=\?')
+    login_failures = _request_counter(
+        lambda route: route.kind == ROUTE_LOGIN_FAILURE)
+    navigation_count = _request_counter(
+        lambda route: route.kind not in STATS_KINDS)
+    vote_count = _request_counter(lambda route: route.kind == ROUTE_RATE)
 
     user_id_dict = {}
     for row_num, s in enumerate(sessions, start=1):
@@ -709,21 +683,21 @@ def export_sessions(args, ws, db, config):
         did_access_knowledge_base = 0
         proposals_viewed = []
         for r in s.requests:
+            route = r.route
             # Resorted in this request?
-            m = proposal_sort_order_re.search(r.request_url)
-            if m:
-                resorted.append(SORTORDER_MAP[m.group(1)])
+            if route.sort_order is not None:
+                resorted.append(SORTORDER_MAP[route.sort_order])
             
             # Did click external link "Habilitationsordnung" in this request?
-            m2 = access_knowledge_base_rex.match(r.request_url)
-            if m2:
+            if (route.kind == ROUTE_OUTGOING_LINK and
+                    (route.instance, route.link_target) == KNOWLEDGE_BASE_LINK):
                 did_access_knowledge_base += 1
                 
             # Update list of proposals viewed during this session
-            m3 = proposal_rex.match(r.request_url)
-            if m3:
-                proposal_id = int(m3.group('proposal_id'))
-                if not m3.group('is_stats') and ((not proposals_viewed) or (proposal_id != proposals_viewed[-1])):
+            if (route.kind in PROPOSAL_VIEW_KINDS and
+                    route.proposal_id is not None):
+                proposal_id = route.proposal_id
+                if (not proposals_viewed) or (proposal_id != proposals_viewed[-1]):
                     proposals_viewed.append(proposal_id)
 
         
@@ -9,3 +9,8 @@ except NameError:  # Python 2
     import urllib
     compat_urllib_request = urllib
 
+
+try:
+    import urllib.parse as compat_urllib_parse
+except ImportError:  # Python 2
+    import urlparse as compat_urllib_parse
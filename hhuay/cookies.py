@@ -0,0 +1,59 @@
+""" Parsing of the Cookie header stored in the request log
+
+The same cookie strings occur in every request of a session, so results are
+cached by cookie string.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import functools
+import hashlib
+import re
+
+ParsedCookies = collections.namedtuple(
+    'ParsedCookies', ['tracking_cookie', 'user_sid'])
+
+_NO_COOKIES = ParsedCookies(None, None)
+
+_USER_MARKER = '!userid_type:unicode'
+_USER_RE = re.compile(r'[a-f0-9]{40}([^!]+)!userid_type:unicode')
+
+
+def _find_tracking_cookie(cookies):
+    # Value of the first ;-separated token that mentions user_tracking
+    idx = cookies.find('user_tracking')
+    if idx == -1:
+        return None
+    start = cookies.rfind(';', 0, idx) + 1
+    end = cookies.find(';', idx)
+    token = cookies[start:] if end == -1 else cookies[start:end]
+    _, tracking = token.split('=', 1)
+    return tracking
+
+
+def _find_user_sid(cookies):
+    if _USER_MARKER not in cookies:
+        return None
+    m = _USER_RE.search(cookies)
+    if m:
+        return m.group(1)
+    return None
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_cookies(cookies):
+    """ Return the tracking cookie and the logged-in user of a Cookie header
+        as ParsedCookies (both None if not present) """
+    if not cookies:
+        return _NO_COOKIES
+    return ParsedCookies(
+        _find_tracking_cookie(cookies), _find_user_sid(cookies))
+
+
+def tracking_cookie_digest(tracking_cookie):
+    """ The fixed-length value analysis_requestlog stores instead of a
+        tracking cookie, which can be of any length """
+    if tracking_cookie is None:
+        return None
+    return hashlib.sha1(tracking_cookie.encode('utf-8')).hexdigest()
@@ -0,0 +1,270 @@
+""" Database backends for DBConnection
+
+All SQL in this project is written in the MySQL dialect. Backends other than
+MySQL translate statements to their own dialect before executing them.
+"""
+
+from __future__ import unicode_literals
+
+import calendar
+import datetime
+import functools
+import re
+import time
+
+
+class MySQLBackend(object):
+    name = 'mysql'
+
+    def connect(self, config):
+        import mysql.connector
+        import mysql.connector.constants
+
+        flags = [mysql.connector.constants.ClientFlag.FOUND_ROWS]
+        try:
+            host = config.get('db_host')
+            user = config['db_user']
+            password = config.get('db_password')
+            database = config['db_database']
+        except KeyError as ke:
+            raise KeyError('Missing key %s in configuration' % ke.args[0])
+
+        return mysql.connector.connect(
+            user=user, host=host, password=password, database=database,
+            client_flags=flags, get_warnings=True, raise_on_warnings=True)
+
+    def cursor(self, conn, buffered=True):
+        return conn.cursor(buffered=buffered)
+
+    def finish_stream(self, conn):
+        if conn.unread_result:
+            conn.consume_results()
+
+    def translate(self, sql):
+        return [sql]
+
+    def affected_rows(self, cursor):
+        return cursor._rowcount
+
+    def is_ignorable_drop_error(self, err):
+        import mysql.connector.errors
+        # Warning for table not found
+        return (isinstance(err, mysql.connector.errors.DatabaseError) and
+                err.errno == 1051)
+
+    explain_prefix = 'EXPLAIN '
+
+    table_exists_sql = '''SELECT COUNT(*) FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name = %s'''
+
+    view_exists_sql = '''SELECT COUNT(*) FROM information_schema.views
+        WHERE table_schema = DATABASE() AND table_name = %s'''
+
+    index_exists_sql = '''SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s
+            AND index_name = %s'''
+
+    column_names_sql = '''SELECT column_name FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s'''
+
+
+def _sqlite_unix_timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    value = value.strip()
+    fmt = '%Y-%m-%d %H:%M:%S' if len(value) > 10 else '%Y-%m-%d'
+    dt = datetime.datetime.strptime(value[:19], fmt)
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _sqlite_from_unixtime(ts):
+    if ts is None:
+        return None
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_ci(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def _sqlite_regexp(pattern, value):
+    # MySQL's RLIKE is case-insensitive for non-binary strings
+    if pattern is None or value is None:
+        return None
+    return _compile_ci(pattern).search(value) is not None
+
+
+_LITERAL_RE = re.compile(r'''(?x)
+    '(?:[^'\\]|\\.|'')*'|
+    "(?:[^"\\]|\\.|"")*"
+''')
+_PLACEHOLDER_RE = re.compile(r'\x00([0-9]+)\x00')
+
+
+def _split_top_level(s, sep=','):
+    """ Split s at sep, but not inside parentheses """
+    res = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(s):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == sep and depth == 0:
+            res.append(s[start:i])
+            start = i + 1
+    res.append(s[start:])
+    return res
+
+
+def _strip_parens(s):
+    """ Remove parentheses that enclose the whole expression """
+    s = s.strip()
+    while s.startswith('(') and s.endswith(')'):
+        depth = 0
+        for i, c in enumerate(s):
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+                if depth == 0 and i != len(s) - 1:
+                    return s
+        s = s[1:-1].strip()
+    return s
+
+
+@functools.lru_cache(maxsize=1024)
+def translate_to_sqlite(sql):
+    """ Translate a MySQL statement into a list of SQLite statements """
+
+    literals = []
+
+    def protect(m):
+        lit = m.group(0)
+        if lit.startswith('"'):
+            # MySQL treats double quotes as string delimiters
+            lit = "'" + lit[1:-1].replace('""', '"').replace("'", "''") + "'"
+        literals.append(lit)
+        return '\x00%d\x00' % (len(literals) - 1)
+
+    s = _LITERAL_RE.sub(protect, sql).strip()
+    s = s.rstrip(';').strip()
+
+    s = s.replace('%s', '?')
+    s = re.sub(r'(?i)\bRLIKE\b', 'REGEXP', s)
+    s = re.sub(r'(?i)\bCHAR_LENGTH\(', 'LENGTH(', s)
+    s = re.sub(
+        r'(?i)\bint\s+PRIMARY\s+KEY\s+auto_increment\b',
+        'INTEGER PRIMARY KEY AUTOINCREMENT', s)
+    s = re.sub(
+        r'(?i)COUNT\(DISTINCT\s+([^,()]+),\s*([^,()]+)\)',
+        r'COUNT(DISTINCT \1 || char(1) || \2)', s)
+
+    statements = []
+    m = re.match(
+        r'(?is)^CREATE\s+OR\s+REPLACE\s+VIEW\s+([a-zA-Z_0-9]+)\s+AS\s+(.*)$',
+        s)
+    if m:
+        statements.append('DROP VIEW IF EXISTS %s' % m.group(1))
+        s = 'CREATE VIEW %s AS %s' % (m.group(1), _strip_parens(m.group(2)))
+
+    m = re.match(
+        r'(?is)^INSERT\s+INTO\s+([a-zA-Z_0-9]+)\s+SET\s+(.*)$', s)
+    if m:
+        columns = []
+        values = []
+        for assignment in _split_top_level(m.group(2)):
+            col, _, val = assignment.partition('=')
+            columns.append(col.strip())
+            values.append(val.strip())
+        s = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            m.group(1), ', '.join(columns), ', '.join(values))
+
+    index_statements = []
+    m = re.match(
+        r'(?is)^CREATE\s+TABLE\s+([a-zA-Z_0-9]+)\s*\((.*)\)$', s)
+    if m:
+        table = m.group(1)
+        column_defs = []
+        for cdef in _split_top_level(m.group(2)):
+            im = re.match(r'(?is)^\s*INDEX\s*\((.*)\)\s*$', cdef)
+            if im:
+                cols = [c.strip() for c in im.group(1).split(',')]
+                index_statements.append(
+                    'CREATE INDEX %s_%s ON %s (%s)' % (
+                        table, '_'.join(cols), table, ', '.join(cols)))
+            else:
+                column_defs.append(cdef)
+        s = 'CREATE TABLE %s (%s)' % (table, ','.join(column_defs))
+
+    statements.append(s)
+    statements.extend(index_statements)
+    return [
+        _PLACEHOLDER_RE.sub(lambda m: literals[int(m.group(1))], st)
+        for st in statements]
+
+
+class SQLiteBackend(object):
+    name = 'sqlite'
+
+    def connect(self, config):
+        import sqlite3
+
+        try:
+            fn = config['db_file']
+        except KeyError as ke:
+            raise KeyError('Missing key %s in configuration' % ke.args[0])
+
+        conn = sqlite3.connect(fn, timeout=600)
+        # Allow reading on one connection while writing on another
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.create_function('UNIX_TIMESTAMP', 1, _sqlite_unix_timestamp)
+        conn.create_function('FROM_UNIXTIME', 1, _sqlite_from_unixtime)
+        conn.create_function('REGEXP', 2, _sqlite_regexp)
+        return conn
+
+    def cursor(self, conn, buffered=True):
+        # sqlite3 cursors fetch lazily from the local file anyway
+        return conn.cursor()
+
+    def finish_stream(self, conn):
+        pass
+
+    def translate(self, sql):
+        return translate_to_sqlite(sql)
+
+    def affected_rows(self, cursor):
+        return cursor.rowcount
+
+    def is_ignorable_drop_error(self, err):
+        return False
+
+    explain_prefix = 'EXPLAIN QUERY PLAN '
+
+    table_exists_sql = '''SELECT COUNT(*) FROM sqlite_master
+        WHERE type IN ('table', 'view') AND name = %s'''
+
+    view_exists_sql = '''SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'view' AND name = %s'''
+
+    index_exists_sql = '''SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = %s AND name = %s'''
+
+    column_names_sql = 'SELECT name FROM pragma_table_info(%s)'
+
+
+BACKENDS = {
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+def get_backend(config):
+    name = config.get('db_backend', 'mysql')
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError('Unsupported db_backend %r (supported: %s)' % (
+            name, ', '.join(sorted(BACKENDS))))
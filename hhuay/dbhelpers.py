@@ -1,6 +1,114 @@
-import mysql.connector
-import mysql.connector.constants
+import functools
 import re
+import time
+import uuid
+
+from .dbbackends import get_backend
+
+
+_SHAPE_SUBSTITUTIONS = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'"(?:[^"\\]|\\.|"")*"'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\b[0-9]+(?:\.[0-9]+)?\b'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?+)'),
+]
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    """ The shape of a statement: literals and parameters replaced by ? """
+    for rex, replacement in _SHAPE_SUBSTITUTIONS:
+        sql = rex.sub(replacement, sql)
+    return sql.strip().rstrip(';').strip()
+
+
+class ShapeStats(object):
+    __slots__ = 'count', 'total_time', 'max_time', 'slowest_sql', \
+        'slowest_params'
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = -1.0
+        self.slowest_sql = None
+        self.slowest_params = None
+
+
+class QueryStats(object):
+    """ Counts the SQL statements executed and the time spent in them,
+        optionally aggregated by statement shape """
+
+    def __init__(self, by_shape=False):
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes = {} if by_shape else None
+
+    def record(self, sql, params, duration):
+        self.count += 1
+        self.total_time += duration
+        if self.shapes is None:
+            return
+
+        shape = normalize_sql(sql)
+        st = self.shapes.get(shape)
+        if st is None:
+            st = self.shapes[shape] = ShapeStats()
+        st.count += 1
+        st.total_time += duration
+        if duration > st.max_time:
+            st.max_time = duration
+            st.slowest_sql = sql
+            st.slowest_params = params
+
+    def slowest_shapes(self):
+        """ List of (shape, ShapeStats), by total time spent """
+        return sorted(
+            self.shapes.items(), key=lambda item: -item[1].total_time)
+
+
+# Collects statistics of all DBConnections in this process if set
+_query_stats = None
+
+
+def set_query_stats(stats):
+    global _query_stats
+    _query_stats = stats
+
+
+class BatchInserter(object):
+    """ Collect rows and write them out with multi-row INSERT statements """
+
+    def __init__(self, db, table, columns, batch_size=1000):
+        assert re.match(r'^[a-zA-Z_0-9]+$', table)
+        assert batch_size > 0
+        self.db = db
+        self.batch_size = batch_size
+        self.count = 0
+        self._rows = []
+        self._sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        if typ is None:
+            self.flush()
+
+    def add(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        # mysql.connector rewrites INSERT ... VALUES into a multi-row insert
+        self.db.executemany(self._sql, self._rows)
+        self.count += len(self._rows)
+        self._rows = []
 
 
 class DBConnection(object):
@@ -10,31 +118,77 @@ class DBConnection(object):
         self._autocommit = autocommit
         self._committed = False
         self._progress_bars = []
+        self._backend = get_backend(config)
 
     def __enter__(self):
-        flags = [mysql.connector.constants.ClientFlag.FOUND_ROWS]
-        try:
-            host = self.config.get('db_host')
-            user = self.config['db_user']
-            password = self.config.get('db_password')
-            database = self.config['db_database']
-        except KeyError as ke:
-            raise KeyError('Missing key %s in configuration' % ke.args[0])
-
-        self.db = mysql.connector.connect(
-            user=user, host=host, password=password, database=database,
-            client_flags=flags, get_warnings=True, raise_on_warnings=True)
-        self.cursor = self.db.cursor(buffered=True)
+        self.db = self._backend.connect(self.config)
+        self.cursor = self._backend.cursor(self.db, buffered=True)
         return self
 
-    def execute(self, sql, *args, **kwargs):
-        return self.cursor.execute(sql, *args, **kwargs)
+    @property
+    def backend_name(self):
+        return self._backend.name
+
+    def execute(self, sql, params=None):
+        if _query_stats is None:
+            return self._execute(sql, params)
+        start = time.time()
+        try:
+            return self._execute(sql, params)
+        finally:
+            _query_stats.record(sql, params, time.time() - start)
+
+    def _execute(self, sql, params):
+        statements = self._backend.translate(sql)
+        for stmt in statements[:-1]:
+            self.cursor.execute(stmt)
+        if params is None:
+            return self.cursor.execute(statements[-1])
+        return self.cursor.execute(statements[-1], params)
+
+    def stream(self, sql, params=None, chunk_size=10000):
+        """ Iterate over the result rows of a query without buffering the
+            whole result set in client memory.
+            No other query may be run on this connection until the iteration
+            has finished, so write with a second DBConnection. """
+        stats = _query_stats
+        duration = 0.0
+        statement, = self._backend.translate(sql)
+        cursor = self._backend.cursor(self.db, buffered=False)
+        try:
+            start = time.time()
+            if params is None:
+                cursor.execute(statement)
+            else:
+                cursor.execute(statement, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if stats is not None:
+                    # Only count the time spent waiting for the database
+                    duration += time.time() - start
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+                start = time.time()
+        finally:
+            self._backend.finish_stream(self.db)
+            cursor.close()
+            if stats is not None:
+                stats.record(sql, params, duration)
 
-    def executemany(self, sql, *args, **kwargs):
-        return self.cursor.executemany(sql, *args, **kwargs)
+    def executemany(self, sql, seq_params):
+        statement, = self._backend.translate(sql)
+        if _query_stats is None:
+            return self.cursor.executemany(statement, seq_params)
+        start = time.time()
+        try:
+            return self.cursor.executemany(statement, seq_params)
+        finally:
+            _query_stats.record(sql, None, time.time() - start)
 
     def affected_rows(self):
-        return self.cursor._rowcount
+        return self._backend.affected_rows(self.cursor)
 
     def __iter__(self):
         return iter(self.cursor)
@@ -63,16 +217,87 @@ class DBConnection(object):
         self.execute(sql, *args)
         return [r[0] for r in self]
 
+    def explain(self, sql, params=None):
+        """ Return the column names and rows of the query plan of sql """
+        self.execute(self._backend.explain_prefix + sql, params)
+        columns = [d[0] for d in self.cursor.description]
+        return columns, [list(row) for row in self]
+
+    def table_exists(self, tblname):
+        return self.simple_query(
+            self._backend.table_exists_sql, (tblname,))[0] > 0
+
+    def view_exists(self, viewname):
+        return self.simple_query(
+            self._backend.view_exists_sql, (viewname,))[0] > 0
+
+    def column_names(self, tblname):
+        return self.simple_query(self._backend.column_names_sql, (tblname,))
+
+    def ensure_index(self, tblname, columns):
+        """ Create an index on the columns of tblname unless it exists """
+        assert re.match(r'^[a-zA-Z_0-9]+$', tblname)
+        assert all(re.match(r'^[a-zA-Z_0-9]+$', c) for c in columns)
+        index_name = '%s_%s' % (tblname, '_'.join(columns))
+        exists = self.simple_query(
+            self._backend.index_exists_sql, (tblname, index_name))[0] > 0
+        if not exists:
+            self.execute('CREATE INDEX %s ON %s (%s)' % (
+                index_name, tblname, ', '.join(columns)))
+
     def drop_table(self, tblname):
         # No prepared statements, so lets be sure the table name is kosher
         assert re.match(r'^[a-zA-Z_0-9]+$', tblname)
         try:
             self.execute('DROP TABLE IF EXISTS %s;' % tblname)
-        except mysql.connector.errors.DatabaseError as de:
-            if de.errno != 1051:  # Warning for table not found
+        except Exception as e:
+            if not self._backend.is_ignorable_drop_error(e):
                 raise
 
+    def drop_table_or_view(self, name):
+        assert re.match(r'^[a-zA-Z_0-9]+$', name)
+        if self.view_exists(name):
+            self.execute('DROP VIEW %s' % name)
+        else:
+            self.drop_table(name)
+
     def recreate_table(self, tblname, columns_sql):
         self.drop_table(tblname)
         assert re.match(r'^[a-zA-Z_0-9]+$', tblname)
         self.execute('CREATE TABLE %s (%s)' % (tblname, columns_sql))
+
+
+# Every action that writes one of the analysis tables stores a new random
+# generation for it here. Readers that cache results derived from a table
+# (pipeline, snapshots) compare generations, because rebuilding a table
+# often leaves its row count and ids unchanged.
+GENERATIONS_TABLE = 'analysis_generations'
+
+
+def bump_generation(wdb, *tblnames):
+    """ Mark the tables as changed """
+    # Not CREATE TABLE IF NOT EXISTS: MySQL notes that the table exists, and
+    # we raise on warnings
+    if not wdb.table_exists(GENERATIONS_TABLE):
+        wdb.execute('''CREATE TABLE %s (
+            tblname varchar(64) PRIMARY KEY,
+            generation varchar(32) NOT NULL
+        )''' % GENERATIONS_TABLE)
+    for tblname in tblnames:
+        wdb.execute(
+            'DELETE FROM %s WHERE tblname = %%s' % GENERATIONS_TABLE,
+            (tblname,))
+        wdb.execute(
+            'INSERT INTO %s (tblname, generation) VALUES (%%s, %%s)' % (
+                GENERATIONS_TABLE),
+            (tblname, uuid.uuid4().hex))
+
+
+def get_generation(db, tblname):
+    """ The current generation of tblname, None if it was never marked """
+    if not db.table_exists(GENERATIONS_TABLE):
+        return None
+    res = db.simple_query(
+        'SELECT generation FROM %s WHERE tblname = %%s' % GENERATIONS_TABLE,
+        (tblname,))
+    return res[0] if res else None
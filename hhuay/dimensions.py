@@ -0,0 +1,74 @@
+""" Dimension tables for the repeated strings of analysis_requestlog
+
+IP addresses, URLs and user agents are stored once in their own table.
+analysis_requestlog refers to them by an id derived from a hash of the value,
+so that parallel and incremental imports agree on the ids without having to
+coordinate.
+"""
+
+from __future__ import unicode_literals
+
+import functools
+import hashlib
+
+from .dbhelpers import BatchInserter
+
+# (table, value column, SQL type of the value)
+DIMENSIONS = [
+    ('analysis_ip', 'ip_address', 'varchar(255)'),
+    ('analysis_url', 'request_url', 'text'),
+    ('analysis_user_agent', 'user_agent', 'text'),
+]
+
+
+@functools.lru_cache(maxsize=65536)
+def dimension_id(value):
+    """ Stable, positive 63 bit id of a dimension value (None for NULL) """
+    if value is None:
+        return None
+    digest = hashlib.sha1(value.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') >> 1
+
+
+def create_dimension_tables(wdb):
+    for table, column, sql_type in DIMENSIONS:
+        wdb.recreate_table(table, '''
+            id bigint PRIMARY KEY,
+            %s %s
+        ''' % (column, sql_type))
+
+
+class DimensionValues(object):
+    """ The distinct dimension values seen during an import, by table """
+
+    def __init__(self):
+        self.values = {table: {} for table, _, _ in DIMENSIONS}
+
+    def add(self, table, value):
+        """ Return the id of value """
+        value_id = dimension_id(value)
+        if value_id is not None:
+            known = self.values[table].setdefault(value_id, value)
+            if known != value:
+                raise ValueError('Hash collision in %s: %r and %r' % (
+                    table, known, value))
+        return value_id
+
+    def update(self, other):
+        for table, values in other.values.items():
+            for value in values.values():
+                self.add(table, value)
+
+    def write(self, wdb, batch_size=1000):
+        """ Insert the values that are not in the dimension tables yet,
+            returns the number of new values """
+        count = 0
+        for table, column, _ in DIMENSIONS:
+            existing = set(wdb.simple_query('SELECT id FROM %s' % table))
+            with BatchInserter(wdb, table, ('id', column),
+                               batch_size=batch_size) as inserter:
+                for value_id, value in self.values[table].items():
+                    if value_id not in existing:
+                        inserter.add((value_id, value))
+            count += inserter.count
+        return count
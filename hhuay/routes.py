@@ -0,0 +1,173 @@
+""" Classification of request URLs into routes
+
+Every request URL is classified once into a Route: what kind of page or ping
+it is, and the details the analyses need (instance, proposal, sort order,
+outgoing link). The same URLs occur again and again, so results are cached by
+URL. annotate_requests stores the routes in analysis_request_annotations.
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import functools
+import re
+
+from .compat import compat_urllib_parse
+
+Route = collections.namedtuple(
+    'Route', ['kind', 'instance', 'proposal_id', 'sort_order', 'link_target',
+              'page_path'])
+
+# Route kinds, stored in analysis_request_annotations.route_kind
+ROUTE_OTHER = 0
+ROUTE_STATIC = 1
+ROUTE_STATS_PAGE = 2
+ROUTE_STATS_READ_COMMENTS = 3
+ROUTE_STATS_OTHER = 4
+ROUTE_PROPOSAL = 5
+ROUTE_RATE = 6
+ROUTE_LOGIN_FAILURE = 7
+ROUTE_OUTGOING_LINK = 8
+
+STATS_KINDS = frozenset([
+    ROUTE_STATS_PAGE, ROUTE_STATS_READ_COMMENTS, ROUTE_STATS_OTHER])
+
+# Requests the exports count as a view of the proposal in proposal_id. Votes
+# on a proposal are sent to a URL below the proposal page.
+PROPOSAL_VIEW_KINDS = frozenset([ROUTE_PROPOSAL, ROUTE_RATE])
+
+# Persisted columns of a Route (page_path is only needed during annotation)
+ROUTE_COLUMNS = (
+    'route_kind', 'instance', 'proposal_id', 'sort_order', 'link_target')
+
+# The first matching alternative determines the kind. The order is the one
+# in which the exports used to check their own regular expressions.
+_ROUTE_RE = re.compile(r'''(?x)^(?:
+    (?P<static>
+        /favicon\.ico|
+        /images/|
+        /fanstatic/|
+        /stylesheets/|
+        /robots\.txt|
+        /javascripts|
+        # Technically not static, but very close
+        /admin|
+        /i/[^/]+/instance/[^/]+/settings
+    )|
+    /+(?:i/[^/]+/)?stats/(?P<stats>.*)|
+    (?P<login_failure>/+post_login\?_login_tries=0)|
+    /i/[^/]+/outgoing_link/(?P<link_target>[^?]*)\?|
+    (?P<rate>/.*/rate\.)|
+    /i/[^/]+/proposal/(?P<proposal_id>[0-9]+)-
+)''', re.DOTALL)
+_INSTANCE_RE = re.compile(r'/+i/([^/?]+)')
+_SORT_ORDER_RE = re.compile(r'&proposals_sort=([0-9]+)')
+_COMMENTS_PROPOSAL_RE = re.compile(r'/proposal/([0-9]+)-')
+_PROPOSAL_PAGE_RE = re.compile(r'/i/[^/]+/proposal/([0-9]+)-')
+
+
+def _parse_stats_ping(stats_url):
+    """ Return the path of the page a /stats/ request refers to (or None),
+        and whether it reports reading the comments.
+        stats_url is the part after /stats/ """
+    action, _, query = stats_url.partition('?')
+    params = compat_urllib_parse.parse_qs(query)
+    if action == 'on_page' and params.get('page'):
+        parts = compat_urllib_parse.urlsplit(params['page'][0])
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+        return path, False
+    if action == 'read_comments' and params.get('path'):
+        return params['path'][0], True
+    return None, False
+
+
+def _classify_stats(stats_url, instance, sort_order):
+    page_path, is_read_comments = _parse_stats_ping(stats_url)
+    if page_path is None:
+        return Route(
+            ROUTE_STATS_OTHER, instance, None, sort_order, None, None)
+
+    page = classify_url(page_path)
+    if instance is None:
+        instance = page.instance
+    if is_read_comments:
+        m = _COMMENTS_PROPOSAL_RE.search(page_path)
+        proposal_id = int(m.group(1)) if m else None
+        return Route(
+            ROUTE_STATS_READ_COMMENTS, instance, proposal_id, sort_order,
+            None, page_path)
+    proposal_id = page.proposal_id if page.kind == ROUTE_PROPOSAL else None
+    return Route(
+        ROUTE_STATS_PAGE, instance, proposal_id, sort_order, None, page_path)
+
+
+@functools.lru_cache(maxsize=65536)
+def classify_url(url):
+    """ Return the Route of a request URL (path and query) """
+    m = _INSTANCE_RE.match(url)
+    instance = m.group(1) if m else None
+    m = _SORT_ORDER_RE.search(url)
+    sort_order = int(m.group(1)) if m else None
+
+    m = _ROUTE_RE.match(url)
+    if m is None:
+        kind = ROUTE_OTHER
+    elif m.group('static') is not None:
+        kind = ROUTE_STATIC
+    elif m.group('stats') is not None:
+        return _classify_stats(m.group('stats'), instance, sort_order)
+    elif m.group('login_failure') is not None:
+        kind = ROUTE_LOGIN_FAILURE
+    elif m.group('link_target') is not None:
+        return Route(
+            ROUTE_OUTGOING_LINK, instance, None, sort_order,
+            m.group('link_target'), None)
+    elif m.group('rate') is not None:
+        m = _PROPOSAL_PAGE_RE.match(url)
+        proposal_id = int(m.group(1)) if m else None
+        return Route(
+            ROUTE_RATE, instance, proposal_id, sort_order, None, None)
+    else:
+        return Route(
+            ROUTE_PROPOSAL, instance, int(m.group('proposal_id')),
+            sort_order, None, None)
+    return Route(kind, instance, None, sort_order, None, None)
+
+
+def route_from_row(url, route_row):
+    """ Return the Route stored in the ROUTE_COLUMNS of route_row, or
+        classify url if the request has not been annotated (static files) """
+    if route_row[0] is None:
+        return classify_url(url)
+    return Route(*(tuple(route_row) + (None,)))
+
+
+def add_proposal_views(by_proposal, requests):
+    """ Add the proposal views of a session's annotated requests to
+        by_proposal, a defaultdict from proposal id to objects with
+        request_timestamps, duration and read_comments_count.
+        The duration of a view is taken from the stats pings annotate_requests
+        attributed to it. Comment reads are counted from the read_comments
+        pings themselves, so that pings without a matching page view (for
+        example from another IP address) are still counted. """
+    for r in requests:
+        route = r.route
+        if route.proposal_id is None:
+            continue
+        if route.kind == ROUTE_STATS_READ_COMMENTS:
+            vdata = by_proposal[route.proposal_id]
+            if not vdata.request_timestamps:
+                vdata.request_timestamps.append(r.access_time)
+            vdata.read_comments_count += 1
+            continue
+        if route.kind not in PROPOSAL_VIEW_KINDS:
+            continue
+        vdata = by_proposal[route.proposal_id]
+        vdata.request_timestamps.append(r.access_time)
+        end_time = r.access_time
+        if r.duration is not None:
+            end_time += r.duration
+        vdata.duration = max(
+            vdata.duration, end_time - vdata.request_timestamps[0])
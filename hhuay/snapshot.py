@@ -0,0 +1,207 @@
+""" Local columnar snapshots of analysis_requestlog_combined
+
+The cleaned and annotated request log is stored as NumPy arrays in a single
+.npz file. String columns are dictionary-encoded: every distinct value is
+stored once (as one UTF-8 blob plus offsets) and each row only stores an
+integer code into that dictionary, with -1 for NULL.
+"""
+
+from __future__ import unicode_literals
+
+import array
+import json
+import os
+
+from .compat import compat_str
+from .dbhelpers import get_generation
+
+SNAPSHOT_FN = os.path.join('.cache', 'requestlog_combined.npz')
+FORMAT_VERSION = 1
+
+# (name, is_string)
+COLUMNS = [
+    ('id', False),
+    ('access_time', False),
+    ('ip_address', True),
+    ('request_url', True),
+    ('cookies', True),
+    ('user_agent', True),
+    ('method', True),
+    ('user_sid', True),
+    ('duration', False),
+    ('detail_json', True),
+]
+
+
+def db_fingerprint(db):
+    """ A cheap summary of the tables the snapshot is built from.
+        Counts and ids survive a rebuild of the tables, so this also
+        includes the generations stored by the actions writing them. """
+    res = []
+    for tbl in ('analysis_requestlog_undeleted',
+                'analysis_request_annotations'):
+        db.execute('SELECT COUNT(*), MAX(id) FROM ' + tbl)
+        count, max_id = list(db)[0]
+        res.append([tbl, count, max_id])
+    for tbl in ('analysis_requestlog', 'analysis_requestlog_undeleted',
+                'analysis_request_annotations',
+                'analysis_requestlog_combined'):
+        res.append([tbl, get_generation(db, tbl)])
+    return {
+        'version': FORMAT_VERSION,
+        'tables': res,
+    }
+
+
+class _StringEncoder(object):
+    def __init__(self):
+        self.codes = array.array('i')
+        self._dict = {}
+        self._values = []
+
+    def add(self, value):
+        if value is None:
+            self.codes.append(-1)
+            return
+        code = self._dict.get(value)
+        if code is None:
+            code = self._dict[value] = len(self._values)
+            self._values.append(value)
+        self.codes.append(code)
+
+    def arrays(self, np):
+        encoded = [v.encode('utf-8') for v in self._values]
+        lengths = np.array([len(e) for e in encoded], dtype=np.int64)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return np.frombuffer(self.codes, dtype=np.int32), offsets, blob
+
+
+class _IntEncoder(object):
+    def __init__(self):
+        self.values = array.array('q')
+        self.nulls = array.array('b')
+
+    def add(self, value):
+        self.nulls.append(value is None)
+        self.values.append(0 if value is None else value)
+
+    def arrays(self, np):
+        return (
+            np.frombuffer(self.values, dtype=np.int64),
+            np.frombuffer(self.nulls, dtype=np.int8).astype(bool))
+
+
+def write_snapshot(db, fn=SNAPSHOT_FN, bar=None):
+    """ Dump analysis_requestlog_combined into fn, returns the row count """
+    import numpy as np
+
+    fingerprint = db_fingerprint(db)
+
+    encoders = [
+        _StringEncoder() if is_string else _IntEncoder()
+        for _, is_string in COLUMNS]
+    rows = db.stream(
+        'SELECT %s FROM analysis_requestlog_combined ORDER BY access_time, id'
+        % ', '.join(name for name, _ in COLUMNS))
+    count = 0
+    for row in rows:
+        if bar is not None:
+            bar.next()
+        for enc, value in zip(encoders, row):
+            enc.add(value)
+        count += 1
+
+    data = {
+        'fingerprint': np.array([json.dumps(fingerprint)]),
+    }
+    for (name, is_string), enc in zip(COLUMNS, encoders):
+        if is_string:
+            codes, offsets, blob = enc.arrays(np)
+            data[name] = codes
+            data[name + '__offsets'] = offsets
+            data[name + '__blob'] = blob
+        else:
+            values, nulls = enc.arrays(np)
+            data[name] = values
+            data[name + '__nulls'] = nulls
+
+    dirname = os.path.dirname(fn)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp_fn = fn + '.tmp.npz'
+    np.savez(tmp_fn, **data)
+    os.rename(tmp_fn, fn)
+    return count
+
+
+class Snapshot(object):
+    """ Read access to a snapshot file. Columns are loaded lazily. """
+
+    def __init__(self, fn=SNAPSHOT_FN):
+        import numpy as np
+        self._npz = np.load(fn)
+        self._arrays = {}
+        self._dictionaries = {}
+        self.fingerprint = json.loads(compat_str(self._array('fingerprint')[0]))
+
+    def _array(self, key):
+        res = self._arrays.get(key)
+        if res is None:
+            res = self._arrays[key] = self._npz[key]
+        return res
+
+    def __len__(self):
+        return len(self._array('id'))
+
+    def column(self, name):
+        """ Numeric values, or dictionary codes for string columns """
+        return self._array(name)
+
+    def nulls(self, name):
+        """ Boolean mask of NULL values in a numeric column """
+        return self._array(name + '__nulls')
+
+    def dictionary(self, name):
+        """ List of the distinct values of a string column, by code """
+        res = self._dictionaries.get(name)
+        if res is None:
+            offsets = self._array(name + '__offsets').tolist()
+            blob = self._array(name + '__blob').tobytes()
+            res = [
+                blob[start:end].decode('utf-8')
+                for start, end in zip(offsets, offsets[1:])]
+            self._dictionaries[name] = res
+        return res
+
+    def values(self, name, mask=None):
+        """ Decoded values of a column as a list, NULLs are None """
+        is_string = dict(COLUMNS)[name]
+        col = self.column(name)
+        if is_string:
+            dictionary = self.dictionary(name)
+            codes = col if mask is None else col[mask]
+            return [None if c < 0 else dictionary[c] for c in codes.tolist()]
+
+        nulls = self.nulls(name)
+        if mask is not None:
+            col = col[mask]
+            nulls = nulls[mask]
+        return [
+            None if n else v
+            for v, n in zip(col.tolist(), nulls.tolist())]
+
+    def rows(self, names, mask=None):
+        """ List of tuples of the decoded columns (in access_time order) """
+        return list(zip(*[self.values(name, mask) for name in names]))
+
+
+def load_fresh_snapshot(db, fn=SNAPSHOT_FN):
+    """ Return the Snapshot in fn if it matches the database, None otherwise """
+    if not os.path.exists(fn):
+        return None
+    snap = Snapshot(fn)
+    if snap.fingerprint != db_fingerprint(db):
+        return None
+    return snap
@@ -1,13 +1,19 @@
+import calendar
 import collections
+import gzip
+import heapq
+import io
+import re
 
 from . import util
 from .util import NoProgress
 from .filters import filter_config_dates
+from .snapshot import load_fresh_snapshot
 
 
 Request = collections.namedtuple(
     'Request',
-    ('time', 'ip', 'path', 'cookies', 'user_agent')
+    ('time', 'ip', 'path', 'cookies', 'user_agent', 'source_id', 'method')
 )
 
 User = collections.namedtuple(
@@ -31,13 +37,121 @@ Proposal = collections.namedtuple(
 )
 
 
-def get_requests_from_db(db):
-    db.execute(
-        '''SELECT
-            UNIX_TIMESTAMP(requestlog.access_time), requestlog.ip_address, requestlog.request_url, requestlog.cookies, requestlog.user_agent
-            FROM requestlog''')
-    for row in db:
-        yield Request(*row)
+def get_requests_from_db(db, after_id=None, until_id=None):
+    """ Yield requests from the platform's requestlog table, optionally only
+        the ones with after_id < id <= until_id """
+    sql = '''SELECT
+            UNIX_TIMESTAMP(requestlog.access_time), requestlog.ip_address, requestlog.request_url, requestlog.cookies, requestlog.user_agent, requestlog.id
+            FROM requestlog'''
+    conditions = []
+    params = []
+    if after_id is not None:
+        conditions.append('requestlog.id > %s')
+        params.append(after_id)
+    if until_id is not None:
+        conditions.append('requestlog.id <= %s')
+        params.append(until_id)
+
+    if conditions:
+        rows = db.stream(
+            sql + ' WHERE ' + ' AND '.join(conditions) +
+            ' ORDER BY requestlog.id',
+            tuple(params))
+    else:
+        rows = db.stream(sql)
+    for row in rows:
+        yield Request(*row, method='')
+
+
+# Apache combined log format, optionally followed by the cookie header:
+# LogFormat "%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\" \"%{Cookie}i\""
+_LOG_LINE_RE = re.compile(r'''(?x)^
+    (?P<ip>\S+)\s+\S+\s+\S+\s+
+    \[(?P<time>[^\]]+)\]\s+
+    "(?P<method>[A-Z]+)\s+(?P<path>\S+)(?:\s+HTTP/[0-9.]+)?"\s+
+    [0-9]{3}\s+(?:[0-9]+|-)
+    (?:
+        \s+"(?:[^"\\]|\\.)*"
+        \s+"(?P<user_agent>(?:[^"\\]|\\.)*)"
+        (?:\s+"(?P<cookies>(?:[^"\\]|\\.)*)")?
+    )?
+    \s*$''')
+
+_MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+
+def parse_log_time(s):
+    """ Convert an Apache timestamp like 10/Oct/2000:13:55:36 -0700 into a
+        UNIX timestamp """
+    date_str, _, tz = s.partition(' ')
+    day, month, rest = date_str.split('/')
+    year, hour, minute, second = rest.split(':')
+    ts = calendar.timegm((
+        int(year), _MONTHS[month], int(day),
+        int(hour), int(minute), int(second)))
+    if tz:
+        offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+        ts -= offset if tz[0] == '+' else -offset
+    return ts
+
+
+def _log_field(value):
+    if value is None or value == '-':
+        return None
+    return value.replace('\\"', '"')
+
+
+def _read_logfile(fileidx, f, discardf):
+    last_time_str = None
+    last_time = None
+    for lineno, line in enumerate(f):
+        m = _LOG_LINE_RE.match(line)
+        if not m:
+            if discardf is not None:
+                discardf.write(line)
+            continue
+
+        # Consecutive lines usually share the same timestamp
+        time_str = m.group('time')
+        if time_str != last_time_str:
+            last_time = parse_log_time(time_str)
+            last_time_str = time_str
+
+        req = Request(
+            last_time, m.group('ip'), m.group('path'),
+            _log_field(m.group('cookies')), _log_field(m.group('user_agent')),
+            None, m.group('method'))
+        yield (last_time, fileidx, lineno, req)
+
+
+def get_requests_from_logfiles(filenames, discardf=None, progress=True):
+    """ Yield the requests of multiple Apache access logs (plain or gzip),
+        merged in timestamp order """
+    raw_files = [io.open(fn, 'rb') for fn in filenames]
+    try:
+        streams = []
+        for fn, raw in zip(filenames, raw_files):
+            if fn.endswith('.gz'):
+                raw_stream = gzip.GzipFile(fileobj=raw, mode='rb')
+            else:
+                raw_stream = raw
+            streams.append(io.TextIOWrapper(
+                raw_stream, encoding='utf-8', errors='replace'))
+
+        pbar = util.FileProgress(*raw_files) if progress else NoProgress(None)
+        merged = heapq.merge(*[
+            _read_logfile(fileidx, stream, discardf)
+            for fileidx, stream in enumerate(streams)])
+        for _, _, _, req in merged:
+            pbar.update()
+            yield req
+        pbar.finish()
+    finally:
+        for raw in raw_files:
+            raw.close()
 
 
 def get_votes_from_db(db):
@@ -97,12 +211,22 @@ def get_all_actions(config, db):
     ]
 
     # make a list of (time, user) for each action
-    db.execute(
-        '''SELECT access_time, user_sid, request_url, method
-        FROM analysis_requestlog_combined
-        WHERE user_sid IS NOT NULL AND user_sid != 'admin'
-        ORDER BY access_time''')
-    all_requests = list(db)
+    snap = load_fresh_snapshot(db)
+    if snap is None:
+        db.execute(
+            '''SELECT access_time, user_sid, request_url, method
+            FROM analysis_requestlog_combined
+            WHERE user_sid IS NOT NULL AND user_sid != 'admin'
+            ORDER BY access_time''')
+        all_requests = list(db)
+    else:
+        user_codes = snap.column('user_sid')
+        user_sids = snap.dictionary('user_sid')
+        mask = user_codes >= 0
+        if 'admin' in user_sids:
+            mask &= user_codes != user_sids.index('admin')
+        all_requests = snap.rows(
+            ['access_time', 'user_sid', 'request_url', 'method'], mask)
 
     matching_requests = dict(
         (mname,
@@ -8,7 +8,6 @@ import io
 import json
 import gzip
 import os
-import re
 import sys
 import time
 
@@ -18,6 +17,8 @@ from .compat import (
     compat_str,
     compat_urllib_request,
 )
+from .cookies import parse_cookies
+from . import dbhelpers
 from .dbhelpers import DBConnection
 
 
@@ -48,14 +49,16 @@ class NoProgress(object):
 
 class FileProgress(object):
 
-    def __init__(self, stream):
-        pos = stream.tell()
-        stream.seek(0, 2)
-        self.size = stream.tell()
-        stream.seek(pos, 0)
+    def __init__(self, *streams):
+        self.size = 0
+        for stream in streams:
+            pos = stream.tell()
+            stream.seek(0, 2)
+            self.size += stream.tell()
+            stream.seek(pos, 0)
         self.bar = progress.bar.Bar(
             '', max=self.size, suffix='%(percent)d%% ETA %(eta)ds')
-        self.stream = stream
+        self.streams = streams
 
         self.update_every = 1000
         self._update_counter = 0
@@ -64,7 +67,7 @@ class FileProgress(object):
         self._update_counter += 1
         if self._update_counter % self.update_every != 0:
             return
-        pos = self.stream.tell()
+        pos = sum(stream.tell() for stream in self.streams)
         self.bar.goto(pos)
 
     def finish(self):
@@ -104,19 +107,123 @@ class Option(object):
 
 def options(option_list=[], requires_db=True):
     def wrapper(func):
-        def outfunc(args):
+        def run(args):
             if requires_db:
                 config = read_config(args)
                 with DBConnection(config) as db, DBConnection(config) as wdb:
                     func(args, config, db, wdb)
             else:
                 return func(args)
+
+        def outfunc(args):
+            if (getattr(args, 'profile', False) or
+                    getattr(args, 'query_log', False)):
+                return run_instrumented(func.__name__, args, run)
+            return run(args)
         outfunc.option_list = option_list
         outfunc.__name__ = func.__name__
         return outfunc
     return wrapper
 
 
+def run_instrumented(name, args, func):
+    """ Run func(args) and write reports about the resources (--profile) and
+        the SQL statements (--query-log) it used into output/ """
+    import cProfile
+    import tracemalloc
+
+    action_name = name.partition('action_')[2] or name
+    report_suffix = '%s_%s' % (
+        action_name, time.strftime('%Y%m%d-%H%M%S', time.gmtime()))
+    stats = dbhelpers.QueryStats(by_shape=args.query_log)
+    dbhelpers.set_query_stats(stats)
+    profiler = None
+    if args.profile:
+        if args.profile_pstats:
+            profiler = cProfile.Profile()
+        tracemalloc.start()
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        return func(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall_time = time.time() - start_wall
+        cpu_time = time.process_time() - start_cpu
+        dbhelpers.set_query_stats(None)
+
+        if args.profile:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            write_data('profile_' + report_suffix, {
+                'action': action_name,
+                'argv': sys.argv[1:],
+                'wall_time': wall_time,
+                'cpu_time': cpu_time,
+                'peak_memory': peak_memory,
+                'sql_statements': stats.count,
+                'sql_time': stats.total_time,
+            })
+            sys.stderr.write(
+                'Profile: %.1fs wall, %.1fs CPU, %d KiB peak memory, '
+                '%d SQL statements taking %.1fs\n' % (
+                    wall_time, cpu_time, peak_memory // 1024,
+                    stats.count, stats.total_time))
+            if profiler is not None:
+                profiler.dump_stats(os.path.join(
+                    ROOT_DIR, 'output', 'profile_' + report_suffix + '.pstats'))
+
+        if args.query_log:
+            write_query_log(
+                'querylog_' + report_suffix, stats, read_config(args),
+                args.query_log_top)
+
+
+def write_query_log(name, stats, config, top):
+    """ Write statement shapes by total time, with the query plans of the
+        slowest instances of the top shapes """
+    shapes = stats.slowest_shapes()
+    report = []
+    with DBConnection(config) as db:
+        for rank, (shape, st) in enumerate(shapes):
+            entry = {
+                'shape': shape,
+                'count': st.count,
+                'total_time': st.total_time,
+                'max_time': st.max_time,
+            }
+            if rank < top:
+                entry['slowest_sql'] = st.slowest_sql
+                entry['slowest_params'] = (
+                    None if st.slowest_params is None
+                    else [compat_str(p) for p in st.slowest_params])
+                if shape.lstrip('( ').upper().startswith('SELECT'):
+                    try:
+                        columns, rows = db.explain(
+                            st.slowest_sql, st.slowest_params)
+                        entry['explain'] = {
+                            'columns': columns,
+                            'rows': [[compat_str(v) for v in row]
+                                     for row in rows],
+                        }
+                    except Exception as e:
+                        entry['explain_error'] = compat_str(e)
+            report.append(entry)
+
+    write_data(name, {
+        'sql_statements': stats.count,
+        'sql_time': stats.total_time,
+        'shapes': report,
+    })
+    sys.stderr.write('Slowest SQL statement shapes:\n')
+    for shape, st in shapes[:top]:
+        sys.stderr.write('%8.2fs %6dx  %s\n' % (
+            st.total_time, st.count, shape[:120]))
+
+
 def read_config(args):
     with io.open(args.config_filename, 'r', encoding='utf-8') as configf:
         return json.load(configf)
@@ -186,10 +293,16 @@ def get_table_size(db, table):
         sys.stdout.write('\r\x1b[K')
         sys.stdout.flush()
 
-    if not os.path.exists('.cache'):
+    try:
         os.mkdir('.cache')
-    with io.open(fn, 'w', encoding='ascii') as outf:
+    except OSError:
+        if not os.path.isdir('.cache'):
+            raise
+    # Concurrent pipeline stages may read the file while we write it
+    tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+    with io.open(tmp_fn, 'w', encoding='ascii') as outf:
         outf.write(compat_str(count))
+    os.rename(tmp_fn, fn)
     return count
 
 
@@ -203,14 +316,19 @@ class TableSizeProgressBar(ProgressBar):
         db.register_bar(self)
 
 
-_user_rex = re.compile(r'[a-f0-9]{40}([^!]+)!userid_type:unicode')
-
-
 def extract_user_from_cookies(cookies, default=None):
-    m = _user_rex.search(cookies)
-    if m:
-        return m.group(1)
-    return default
+    user_sid = parse_cookies(cookies).user_sid
+    if user_sid is None:
+        return default
+    return user_sid
+
+
+def print_throughput(description, count, start_time):
+    """ Print how many rows per second we processed since start_time """
+    duration = time.time() - start_time
+    rate = count / duration if duration > 0 else count
+    print('%s %d rows in %.1fs (%d rows/s)' % (
+        description, count, duration, rate))
 
 
 def sql_filter(name, config):
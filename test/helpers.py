@@ -0,0 +1,243 @@
+""" Test fixtures: a throwaway SQLite database with a platform requestlog """
+
+from __future__ import unicode_literals
+
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+import hhuay
+from hhuay.dbhelpers import DBConnection
+
+BOT_USER_AGENT = 'Mozilla/5.0 (compatible; bingbot/2.0)'
+USER_AGENTS = [
+    'Mozilla/5.0 (X11; Linux x86_64) Firefox/38.0',
+    'Mozilla/5.0 (Windows NT 6.1) Chrome/43.0',
+    'Mozilla/5.0 (iPhone; mobile) Safari/600.1',
+]
+PAGES = [
+    '/i/grundsaetze/proposal/%d-Titel' % pid for pid in range(1, 6)
+] + [
+    '/i/grundsaetze/proposal?proposals_sort=2',
+    '/i/grundsaetze/instance/grundsaetze',
+]
+
+
+def user_cookies(tracking, user=None):
+    """ A Cookie header as the platform sets it """
+    res = 'adhocracy_lang=de; user_tracking=%s' % tracking
+    if user is not None:
+        res += '; adhocracy_login="%s%s!userid_type:unicode"' % (
+            '0123456789abcdef0123456789abcdef01234567', user)
+    return res
+
+
+def _timestr(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))
+
+
+def generate_requests(visitors=12, seed=1):
+    """ (access_time, ip_address, request_url, cookies, user_agent) of some
+        visitors browsing proposals, including stats pings, static files,
+        bots and requests without cookies. Sorted by access time. """
+    rnd = random.Random(seed)
+    start = 1430000000  # 2015-04-25
+    res = []
+    for v in range(visitors):
+        ip = '134.99.%d.%d' % (v % 3, v)
+        ua = USER_AGENTS[v % len(USER_AGENTS)]
+        cookies = user_cookies(
+            't%04d' % v, user='user%d' % v if v % 2 else None)
+        t = start + rnd.randint(0, 3600)
+        for _ in range(rnd.randint(3, 8)):
+            page = rnd.choice(PAGES)
+            res.append((t, ip, page, cookies, ua))
+            res.append((t + 1, ip, '/fanstatic/app.js', cookies, ua))
+            for ping in range(rnd.randint(0, 4)):
+                res.append((
+                    t + 30 * (ping + 1), ip,
+                    '/stats/on_page?page=%s' % page, cookies, ua))
+            if '/proposal/' in page and rnd.random() < 0.5:
+                res.append((
+                    t + 20, ip, '/stats/read_comments?path=%s' % page,
+                    cookies, ua))
+            if '/proposal/' in page and rnd.random() < 0.3:
+                res.append((t + 25, ip, page + '/rate.json', cookies, ua))
+            # Sometimes the next view is in a new session
+            t += rnd.choice([40, 150, 900, 5000])
+        # A late ping that must not extend the last page view
+        res.append((
+            t + 100000, ip, '/stats/on_page?page=%s' % page, cookies, ua))
+    for i in range(20):
+        res.append((
+            start + 100 * i, '66.249.0.1', rnd.choice(PAGES), None,
+            BOT_USER_AGENT))
+        res.append((
+            start + 100 * i + 7, '10.0.0.%d' % i, rnd.choice(PAGES), None,
+            USER_AGENTS[0]))
+    res.sort(key=lambda r: r[0])
+    return res
+
+
+def create_requestlog(db, requests):
+    """ Create the platform's requestlog table from generate_requests """
+    db.execute('''CREATE TABLE requestlog (
+        id INTEGER PRIMARY KEY,
+        access_time datetime,
+        ip_address varchar(255),
+        request_url text,
+        cookies text,
+        user_agent text
+    )''')
+    db.executemany(
+        '''INSERT INTO requestlog
+            (access_time, ip_address, request_url, cookies, user_agent)
+            VALUES (%s, %s, %s, %s, %s)''',
+        [(_timestr(r[0]),) + tuple(r[1:]) for r in requests])
+    db.commit()
+
+
+class SQLiteTestCase(unittest.TestCase):
+    """ Runs in a temporary directory with a configuration for an empty
+        SQLite database """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='hhuay-test-')
+        self._old_cwd = os.getcwd()
+        # Actions cache table sizes in .cache of the working directory
+        os.chdir(self.tmpdir)
+        self.config = {
+            'db_backend': 'sqlite',
+            'db_file': os.path.join(self.tmpdir, 'test.sqlite'),
+            'startdate': '2015-01-01',
+            'enddate': '2015-12-31',
+        }
+        self.config_fn = os.path.join(self.tmpdir, 'config.json')
+        with io.open(self.config_fn, 'w', encoding='utf-8') as cfgf:
+            cfgf.write(json.dumps(self.config))
+
+    def tearDown(self):
+        os.chdir(self._old_cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def connect(self):
+        return DBConnection(self.config)
+
+    def create_requestlog(self, requests=None):
+        if requests is None:
+            requests = generate_requests()
+        with self.connect() as db:
+            create_requestlog(db, requests)
+
+    def run_action(self, *argv):
+        """ Run an ay action, return what it printed """
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            hhuay.main(list(argv) + ['--config', self.config_fn])
+        return out.getvalue()
+
+    def prepare(self):
+        """ Load and clean the fixture and annotate the requests """
+        self.create_requestlog()
+        self.run_action('load_requestlog')
+        self.run_action('cleanup_requestlog')
+        self.run_action('annotate_requests')
+
+
+def create_platform_tables(db, requests=None):
+    """ The tables of the platform the exports read, with some users,
+        proposals, comments and votes matching generate_requests """
+    if requests is None:
+        requests = generate_requests()
+    start = min(r[0] for r in requests)
+    schema = [
+        '''user (id int PRIMARY KEY, email varchar(255),
+            user_name varchar(255), display_name varchar(255),
+            gender varchar(1), proposal_sort_order int, delete_time datetime)''',
+        'badge (id int PRIMARY KEY, title varchar(255))',
+        'user_badges (user_id int, badge_id int)',
+        'instance (id int PRIMARY KEY, `key` varchar(255))',
+        '''delegateable (id int PRIMARY KEY, label varchar(255),
+            delete_time datetime, create_time datetime, creator_id int,
+            type varchar(50), instance_id int)''',
+        'proposal (id int PRIMARY KEY, description_id int)',
+        'page (id int PRIMARY KEY)',
+        '''text (id int PRIMARY KEY, page_id int, title varchar(255),
+            text text, create_time datetime)''',
+        '''comment (id int PRIMARY KEY, creator_id int, create_time datetime,
+            delete_time datetime, topic_id int)''',
+        '''revision (id int PRIMARY KEY, comment_id int, user_id int,
+            text text, create_time datetime)''',
+        'poll (id int PRIMARY KEY, subject varchar(255))',
+        '''vote (id int PRIMARY KEY, user_id int, poll_id int,
+            orientation int, create_time datetime)''',
+    ]
+    for table_sql in schema:
+        db.execute('CREATE TABLE ' + table_sql)
+
+    def insert(table, rows):
+        db.executemany('INSERT INTO %s VALUES (%s)' % (
+            table, ', '.join(['%s'] * len(rows[0]))), rows)
+
+    users = [(1, 'admin@example.com', 'admin', 'Admin', 'm', 1, None)]
+    users += [
+        (v + 2, 'user%d@example.com' % v, 'user%d' % v, 'User %d' % v,
+         'mf'[v % 2], v % 5 + 1, None)
+        for v in range(12)]
+    users.append((
+        20, 'gone@example.com', 'gone', 'Gone', 'f', 1, _timestr(start)))
+    insert('user', users)
+    insert('badge', [(1, 'Promovend/in'), (2, 'Andere')])
+    insert('user_badges', [(3, 1), (4, 2), (5, 1)])
+    insert('instance', [(1, 'grundsaetze'), (2, 'test')])
+
+    proposals = range(1, 6)
+    insert('delegateable', [
+        (pid, 'Proposal %d' % pid, None, _timestr(start - 86400 * pid),
+         2 + pid, 'proposal', 1)
+        for pid in proposals])
+    insert('proposal', [(pid, 100 + pid) for pid in proposals])
+    insert('page', [(100 + pid,) for pid in proposals])
+    insert('text', [
+        (pid, 100 + pid, 'Proposal %d' % pid, 'Text ' * (10 * pid),
+         _timestr(start - 86400 * pid + 1))
+        for pid in proposals])
+
+    comments = []
+    revisions = []
+    polls = [(pid, '@[proposal:%d]' % pid) for pid in proposals]
+    votes = []
+    for cid in range(1, 16):
+        pid = cid % 5 + 1
+        creator = cid % 12 + 2
+        ctime = start + 600 * cid
+        comments.append((
+            cid, creator, _timestr(ctime),
+            _timestr(ctime + 3000) if cid % 7 == 0 else None, 100 + pid))
+        revisions.append((cid, cid, creator, 'Comment %d' % cid,
+                          _timestr(ctime)))
+        polls.append((100 + cid, '@[comment:%d]' % cid))
+    vid = 0
+    for pid in proposals:
+        for user_id in range(2, 14):
+            if (user_id + pid) % 3:
+                continue
+            vid += 1
+            votes.append((
+                vid, user_id, pid, 1 if user_id % 2 else -1,
+                _timestr(start + 300 * vid)))
+    for cid in range(1, 16, 2):
+        vid += 1
+        votes.append((vid, cid % 12 + 2, 100 + cid, 1,
+                      _timestr(start + 700 * cid)))
+    insert('comment', comments)
+    insert('revision', revisions)
+    insert('poll', polls)
+    insert('vote', votes)
+    db.commit()
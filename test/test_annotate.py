@@ -0,0 +1,35 @@
+from __future__ import unicode_literals
+
+from hhuay.actions_prepare import (
+    ANNOTATION_COLUMNS,
+    table_digest,
+)
+
+from .helpers import SQLiteTestCase
+
+
+class ParallelAnnotateTest(SQLiteTestCase):
+
+    def _annotate(self, *argv):
+        self.run_action('annotate_requests', *argv)
+        with self.connect() as db:
+            # Only page views with attributed stats pings have a duration
+            count = db.simple_query(
+                'SELECT COUNT(duration) FROM analysis_request_annotations')[0]
+            return count, table_digest(
+                db, 'analysis_request_annotations', ANNOTATION_COLUMNS)
+
+    def test_workers_give_the_same_annotations(self):
+        self.prepare()
+        count, expected = self._annotate('--workers', '1')
+        self.assertTrue(count > 0)
+        for workers in ['2', '3']:
+            self.assertEqual(
+                self._annotate('--workers', workers), (count, expected),
+                '%s workers' % workers)
+
+    def test_horizon_gives_the_same_annotations(self):
+        self.prepare()
+        expected = self._annotate()
+        self.assertEqual(
+            self._annotate('--horizon', '3600', '--workers', '3'), expected)
@@ -0,0 +1,93 @@
+from __future__ import unicode_literals
+
+import re
+import unittest
+
+from hhuay.cookies import (
+    parse_cookies,
+    tracking_cookie_digest,
+)
+
+from .helpers import (
+    generate_requests,
+    user_cookies,
+)
+
+_USER_RE = re.compile(r'[a-f0-9]{40}([^!]+)!userid_type:unicode')
+
+
+def _reference_parse_cookies(cookies):
+    """ The parsing the actions did before cookies.parse_cookies """
+    tracking = None
+    for token in cookies.split(';'):
+        if token.find('user_tracking') != -1:
+            _, tracking = token.split('=', 1)
+            break
+    m = _USER_RE.search(cookies)
+    return tracking, (m.group(1) if m else None)
+
+
+class ParseCookiesTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(parse_cookies(None), (None, None))
+        self.assertEqual(parse_cookies(''), (None, None))
+
+    def test_anonymous(self):
+        parsed = parse_cookies(user_cookies('abc123'))
+        self.assertEqual(parsed.tracking_cookie, 'abc123')
+        self.assertEqual(parsed.user_sid, None)
+
+    def test_logged_in(self):
+        parsed = parse_cookies(user_cookies('abc123', user='alice'))
+        self.assertEqual(parsed.tracking_cookie, 'abc123')
+        self.assertEqual(parsed.user_sid, 'alice')
+
+    def test_tracking_cookie_last(self):
+        self.assertEqual(
+            parse_cookies('a=b; user_tracking=xyz').tracking_cookie, 'xyz')
+        self.assertEqual(
+            parse_cookies('user_tracking=xyz').tracking_cookie, 'xyz')
+
+    def test_first_tracking_cookie_wins(self):
+        parsed = parse_cookies('user_tracking=one; user_tracking=two')
+        self.assertEqual(parsed.tracking_cookie, 'one')
+
+    def test_value_with_equals_sign(self):
+        parsed = parse_cookies('user_tracking=a=b; x=y')
+        self.assertEqual(parsed.tracking_cookie, 'a=b')
+
+    def test_marker_without_user(self):
+        parsed = parse_cookies('x="nohex!userid_type:unicode"')
+        self.assertEqual(parsed.user_sid, None)
+
+    def test_same_as_reference(self):
+        corpus = set(r[3] for r in generate_requests() if r[3])
+        corpus.update([
+            'user_tracking=xyz',
+            'a=b; user_tracking=a=b; x=y',
+            'user_tracking=one; user_tracking=two',
+            'x="nohex!userid_type:unicode"',
+            'adhocracy_login="%s!userid_type:unicode"' % ('f' * 40),
+        ])
+        for cookies in sorted(corpus):
+            self.assertEqual(
+                tuple(parse_cookies(cookies)),
+                _reference_parse_cookies(cookies), cookies)
+
+
+class TrackingCookieDigestTest(unittest.TestCase):
+
+    def test_fixed_length(self):
+        for value in ['', 'abc', 'x' * 1000, 'äöü']:
+            self.assertEqual(len(tracking_cookie_digest(value)), 40)
+
+    def test_distinct_and_stable(self):
+        self.assertEqual(
+            tracking_cookie_digest('abc'),
+            'a9993e364706816aba3e25717850c26c9cd0d89d')
+        self.assertNotEqual(
+            tracking_cookie_digest('abc'), tracking_cookie_digest('abd'))
+
+    def test_none(self):
+        self.assertEqual(tracking_cookie_digest(None), None)
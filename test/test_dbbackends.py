@@ -0,0 +1,132 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from hhuay.dbbackends import translate_to_sqlite
+
+from .helpers import SQLiteTestCase
+
+
+class TranslateToSQLiteTest(unittest.TestCase):
+
+    def assertTranslation(self, sql, expected):
+        if not isinstance(expected, list):
+            expected = [expected]
+        self.assertEqual(translate_to_sqlite(sql), expected)
+
+    def test_unchanged(self):
+        self.assertTranslation(
+            'SELECT id FROM analysis_requestlog WHERE id > 3',
+            'SELECT id FROM analysis_requestlog WHERE id > 3')
+
+    def test_trailing_semicolon(self):
+        self.assertTranslation('SELECT 1;\n  ', 'SELECT 1')
+
+    def test_placeholders(self):
+        self.assertTranslation(
+            'SELECT id FROM t WHERE a = %s AND b IN (%s, %s)',
+            'SELECT id FROM t WHERE a = ? AND b IN (?, ?)')
+
+    def test_double_quoted_strings(self):
+        self.assertTranslation(
+            'SELECT COUNT(*) FROM delegateable WHERE type="proposal"',
+            "SELECT COUNT(*) FROM delegateable WHERE type='proposal'")
+        self.assertTranslation(
+            '''SELECT "it's", "say ""hi"""''',
+            """SELECT 'it''s', 'say "hi"'""")
+
+    def test_literals_are_not_rewritten(self):
+        self.assertTranslation(
+            "SELECT '%s RLIKE x;' FROM t WHERE a RLIKE 'CHAR_LENGTH(%s)'",
+            "SELECT '%s RLIKE x;' FROM t WHERE a REGEXP 'CHAR_LENGTH(%s)'")
+
+    def test_rlike(self):
+        self.assertTranslation(
+            'SELECT id FROM t WHERE ua rlike %s',
+            'SELECT id FROM t WHERE ua REGEXP ?')
+
+    def test_char_length(self):
+        self.assertTranslation(
+            'SELECT SUM(CHAR_LENGTH(text)) FROM revision',
+            'SELECT SUM(LENGTH(text)) FROM revision')
+
+    def test_count_distinct_pairs(self):
+        self.assertTranslation(
+            'SELECT COUNT(DISTINCT user_id, poll_id) FROM vote',
+            'SELECT COUNT(DISTINCT user_id || char(1) || poll_id) FROM vote')
+
+    def test_create_or_replace_view(self):
+        self.assertTranslation(
+            'CREATE OR REPLACE VIEW v AS (SELECT a FROM t);', [
+                'DROP VIEW IF EXISTS v',
+                'CREATE VIEW v AS SELECT a FROM t',
+            ])
+        # Parentheses that do not enclose the whole query are kept
+        self.assertTranslation(
+            'CREATE OR REPLACE VIEW v AS (SELECT a FROM t) UNION (SELECT b FROM u)', [
+                'DROP VIEW IF EXISTS v',
+                'CREATE VIEW v AS (SELECT a FROM t) UNION (SELECT b FROM u)',
+            ])
+
+    def test_insert_set(self):
+        self.assertTranslation(
+            'INSERT INTO t SET a=%s, b = f(1, 2), c="x, y"',
+            "INSERT INTO t (a, b, c) VALUES (?, f(1, 2), 'x, y')")
+
+    def test_create_table(self):
+        self.assertTranslation(
+            '''CREATE TABLE t (
+                id int PRIMARY KEY auto_increment,
+                a int,
+                b varchar(10),
+                INDEX (a),
+                INDEX (a, b)
+            )''', [
+                'CREATE TABLE t (\n'
+                '                id INTEGER PRIMARY KEY AUTOINCREMENT,\n'
+                '                a int,\n'
+                '                b varchar(10))',
+                'CREATE INDEX t_a ON t (a)',
+                'CREATE INDEX t_a_b ON t (a, b)',
+            ])
+
+
+class SQLiteBackendTest(SQLiteTestCase):
+    """ The translated statements and MySQL functions on a real database """
+
+    def test_functions(self):
+        with self.connect() as db:
+            db.execute(
+                "SELECT UNIX_TIMESTAMP('2015-04-25 22:13:20'), "
+                "UNIX_TIMESTAMP('2015-04-25'), FROM_UNIXTIME(1430000000)")
+            self.assertEqual(
+                list(db), [(1430000000, 1429920000, '2015-04-25 22:13:20')])
+
+    def test_rlike_is_case_insensitive(self):
+        with self.connect() as db:
+            self.assertEqual(db.simple_query(
+                "SELECT 'Mozilla (compatible; bingbot/2.0)' RLIKE %s",
+                ('GoogleBot|BingBot',)), [1])
+
+    def test_schema_statements(self):
+        with self.connect() as db:
+            db.recreate_table('t', '''
+                id int PRIMARY KEY auto_increment,
+                a int,
+                INDEX (a)
+            ''')
+            db.execute('INSERT INTO t SET a=%s', (5,))
+            db.execute('INSERT INTO t SET a=%s', (5,))
+            db.execute('INSERT INTO t SET a=%s', (7,))
+            self.assertEqual(db.lastrowid, 3)
+            db.execute('CREATE OR REPLACE VIEW v AS (SELECT a FROM t)')
+            db.execute('CREATE OR REPLACE VIEW v AS (SELECT id FROM t)')
+            self.assertTrue(db.view_exists('v'))
+            self.assertEqual(db.simple_query('SELECT * FROM v'), [1, 2, 3])
+            self.assertEqual(
+                db.simple_query('SELECT COUNT(DISTINCT id, a) FROM t'), [3])
+            self.assertEqual(sorted(db.column_names('t')), ['a', 'id'])
+            db.ensure_index('t', ['a'])
+            self.assertEqual(db.simple_query(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = 't'"), [1])
@@ -0,0 +1,61 @@
+from __future__ import unicode_literals
+
+from hhuay.dbhelpers import BatchInserter
+
+from .helpers import SQLiteTestCase
+
+
+class BatchInserterTest(SQLiteTestCase):
+
+    def setUp(self):
+        super(BatchInserterTest, self).setUp()
+        self.db = self.connect().__enter__()
+        self.db.execute('CREATE TABLE numbers (n int, name text)')
+
+    def tearDown(self):
+        self.db.__exit__(None, None, None)
+        super(BatchInserterTest, self).tearDown()
+
+    def _rows(self):
+        return self.db.simple_query('SELECT n FROM numbers ORDER BY n')
+
+    def test_writes_full_batches(self):
+        inserter = BatchInserter(
+            self.db, 'numbers', ('n', 'name'), batch_size=3)
+        for n in range(7):
+            inserter.add((n, 'row %d' % n))
+        self.assertEqual(inserter.count, 6)
+        self.assertEqual(self._rows(), list(range(6)))
+
+    def test_flush_writes_partial_batch(self):
+        inserter = BatchInserter(
+            self.db, 'numbers', ('n', 'name'), batch_size=3)
+        for n in range(7):
+            inserter.add((n, None))
+        inserter.flush()
+        self.assertEqual(inserter.count, 7)
+        self.assertEqual(self._rows(), list(range(7)))
+
+        inserter.flush()
+        self.assertEqual(inserter.count, 7)
+        self.assertEqual(self._rows(), list(range(7)))
+
+    def test_context_manager_flushes(self):
+        with BatchInserter(self.db, 'numbers', ('n', 'name')) as inserter:
+            inserter.add((1, 'one'))
+            self.assertEqual(self._rows(), [])
+        self.assertEqual(inserter.count, 1)
+        self.db.execute('SELECT n, name FROM numbers')
+        self.assertEqual(list(self.db), [(1, 'one')])
+
+    def test_no_flush_on_error(self):
+        with self.assertRaises(KeyError):
+            with BatchInserter(self.db, 'numbers', ('n', 'name')) as inserter:
+                inserter.add((1, 'one'))
+                raise KeyError('oops')
+        self.assertEqual(inserter.count, 0)
+        self.assertEqual(self._rows(), [])
+
+    def test_rejects_bad_table_name(self):
+        with self.assertRaises(AssertionError):
+            BatchInserter(self.db, 'numbers; DROP TABLE x', ('n',))
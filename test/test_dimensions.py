@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+
+import unittest
+
+from hhuay.dimensions import (
+    create_dimension_tables,
+    dimension_id,
+    DimensionValues,
+)
+
+from .helpers import SQLiteTestCase
+
+
+class DimensionIdTest(unittest.TestCase):
+
+    def test_stable(self):
+        # Incremental imports rely on ids never changing between versions
+        self.assertEqual(dimension_id('134.99.112.1'), 6053077273765935888)
+        self.assertEqual(dimension_id(''), 7862389909061215622)
+        self.assertEqual(dimension_id('ä'), 5408771577176307468)
+
+    def test_range(self):
+        for value in ['a', 'b', '/i/x/proposal/1-x', 'Mozilla/5.0']:
+            self.assertTrue(0 <= dimension_id(value) < 2 ** 63)
+
+    def test_null(self):
+        self.assertEqual(dimension_id(None), None)
+
+
+class DimensionValuesTest(SQLiteTestCase):
+
+    def _values(self, db, table, column):
+        db.execute('SELECT id, %s FROM %s ORDER BY id' % (column, table))
+        return list(db)
+
+    def test_write_only_new_values(self):
+        with self.connect() as wdb:
+            create_dimension_tables(wdb)
+
+            dims = DimensionValues()
+            self.assertEqual(dims.add('analysis_ip', '1.2.3.4'),
+                             dimension_id('1.2.3.4'))
+            dims.add('analysis_ip', '1.2.3.4')
+            self.assertEqual(dims.add('analysis_ip', None), None)
+            dims.add('analysis_url', '/')
+            self.assertEqual(dims.write(wdb), 2)
+
+            dims = DimensionValues()
+            dims.add('analysis_ip', '1.2.3.4')
+            dims.add('analysis_ip', '5.6.7.8')
+            self.assertEqual(dims.write(wdb), 1)
+
+            self.assertEqual(
+                self._values(wdb, 'analysis_ip', 'ip_address'),
+                sorted([
+                    (dimension_id('1.2.3.4'), '1.2.3.4'),
+                    (dimension_id('5.6.7.8'), '5.6.7.8'),
+                ]))
+            self.assertEqual(
+                self._values(wdb, 'analysis_url', 'request_url'),
+                [(dimension_id('/'), '/')])
+
+    def test_update(self):
+        a = DimensionValues()
+        a.add('analysis_user_agent', 'ua1')
+        b = DimensionValues()
+        b.add('analysis_user_agent', 'ua2')
+        a.update(b)
+        self.assertEqual(
+            sorted(a.values['analysis_user_agent'].values()), ['ua1', 'ua2'])
@@ -0,0 +1,218 @@
+from __future__ import unicode_literals
+
+import collections
+import re
+import unittest
+
+from hhuay.actions_tobias_export_promo16 import KNOWLEDGE_BASE_LINK
+from hhuay.actions_tobias_export_promo16 import ViewStats
+from hhuay.routes import (
+    add_proposal_views,
+    classify_url,
+    PROPOSAL_VIEW_KINDS,
+    Route,
+    route_from_row,
+    ROUTE_LOGIN_FAILURE,
+    ROUTE_OTHER,
+    ROUTE_OUTGOING_LINK,
+    ROUTE_PROPOSAL,
+    ROUTE_RATE,
+    ROUTE_STATIC,
+    ROUTE_STATS_OTHER,
+    ROUTE_STATS_PAGE,
+    ROUTE_STATS_READ_COMMENTS,
+    STATS_KINDS,
+)
+
+_LINK = '/i/%s/outgoing_link/%s' % KNOWLEDGE_BASE_LINK
+_ENCODED_PAGE = (
+    'https%3A%2F%2Fnormsetzung.cs.uni-duesseldorf.de%2Fi%2Fgrundsaetze'
+    '%2Fproposal%2F7-Titel')
+
+# URL -> Route
+ROUTE_TABLE = [
+    ('/i/grundsaetze/proposal/12-Titel',
+     Route(ROUTE_PROPOSAL, 'grundsaetze', 12, None, None, None)),
+    ('/i/grundsaetze/proposal/12-Titel?proposals_sort=3&x=1',
+     Route(ROUTE_PROPOSAL, 'grundsaetze', 12, None, None, None)),
+    ('/i/grundsaetze/proposal?x=1&proposals_sort=3',
+     Route(ROUTE_OTHER, 'grundsaetze', None, 3, None, None)),
+    ('/i/grundsaetze/proposal/12-Titel/rate.json',
+     Route(ROUTE_RATE, 'grundsaetze', 12, None, None, None)),
+    ('/i/grundsaetze/comment/5/rate.json?value=1',
+     Route(ROUTE_RATE, 'grundsaetze', None, None, None, None)),
+    ('/post_login?_login_tries=0',
+     Route(ROUTE_LOGIN_FAILURE, None, None, None, None, None)),
+    ('//post_login?_login_tries=0&came_from=/',
+     Route(ROUTE_LOGIN_FAILURE, None, None, None, None, None)),
+    ('/post_login?_login_tries=1',
+     Route(ROUTE_OTHER, None, None, None, None, None)),
+    (_LINK + '?came_from=x',
+     Route(ROUTE_OUTGOING_LINK, KNOWLEDGE_BASE_LINK[0], None, None,
+           KNOWLEDGE_BASE_LINK[1], None)),
+    # Without a query, the platform did not redirect
+    (_LINK,
+     Route(ROUTE_OTHER, KNOWLEDGE_BASE_LINK[0], None, None, None, None)),
+    ('/stats/on_page?page=' + _ENCODED_PAGE,
+     Route(ROUTE_STATS_PAGE, 'grundsaetze', 7, None, None,
+           '/i/grundsaetze/proposal/7-Titel')),
+    ('/i/grundsaetze/stats/read_comments?path=%2Fi%2Fgrundsaetze%2F'
+     'proposal%2F7-Titel',
+     Route(ROUTE_STATS_READ_COMMENTS, 'grundsaetze', 7, None, None,
+           '/i/grundsaetze/proposal/7-Titel')),
+    ('/stats/on_page?page=%2Fi%2Fgrundsaetze%2Fproposal%2F7-Titel%2F'
+     'rate.json',
+     Route(ROUTE_STATS_PAGE, 'grundsaetze', None, None, None,
+           '/i/grundsaetze/proposal/7-Titel/rate.json')),
+    ('/stats/other?x=1',
+     Route(ROUTE_STATS_OTHER, None, None, None, None, None)),
+    ('/fanstatic/jquery/rate.js',
+     Route(ROUTE_STATIC, None, None, None, None, None)),
+    ('/i/grundsaetze/instance/grundsaetze/settings/general',
+     Route(ROUTE_STATIC, 'grundsaetze', None, None, None, None)),
+    ('/',
+     Route(ROUTE_OTHER, None, None, None, None, None)),
+]
+
+# The regular expressions the exports matched URLs with before routes.py
+_OLD_PROPOSAL_RE = re.compile(r'''(?x)^
+    (?:
+        (?P<is_stats>
+            (?:/i/[a-z]+)?
+            /stats/on_page\?
+            page=https%3A%2F%2Fnormsetzung.cs.uni-duesseldorf.de%2Fi%2F[a-z]+%2Fproposal%2F
+        )|
+        /i/[a-z]+/proposal/
+    )
+    (?P<proposal_id>[0-9]+)
+    -.*
+''')
+_OLD_READ_COMMENTS_RE = re.compile(r'''(?x)
+    (?:/i/[a-z]+)?/stats/read_comments\?
+    path=.*?%2Fproposal%2F(?P<proposal_id>[0-9]+)-
+''')
+_OLD_LINK_RE = re.compile(re.escape(_LINK) + r'\?')
+
+
+def _old_counters(url):
+    """ What the old exports counted for a request to url """
+    is_stats = '/stats/' in url
+    m = _OLD_PROPOSAL_RE.match(url)
+    viewed = int(m.group('proposal_id')) if (
+        m and not m.group('is_stats')) else None
+    m = _OLD_READ_COMMENTS_RE.match(url)
+    read_comments = int(m.group('proposal_id')) if m else None
+    return {
+        'navigation': not is_stats,
+        'vote': not is_stats and re.match(r'/.*/rate\.', url) is not None,
+        'login_failure': not is_stats and re.match(
+            r'/+post_login\?_login_tries=0', url) is not None,
+        'knowledge_base': _OLD_LINK_RE.match(url) is not None,
+        'viewed': viewed,
+        'read_comments': read_comments,
+    }
+
+
+def _route_counters(route):
+    return {
+        'navigation': route.kind not in STATS_KINDS,
+        'vote': route.kind == ROUTE_RATE,
+        'login_failure': route.kind == ROUTE_LOGIN_FAILURE,
+        'knowledge_base': (
+            route.kind == ROUTE_OUTGOING_LINK and
+            (route.instance, route.link_target) == KNOWLEDGE_BASE_LINK),
+        'viewed': (
+            route.proposal_id if route.kind in PROPOSAL_VIEW_KINDS
+            else None),
+        'read_comments': (
+            route.proposal_id if route.kind == ROUTE_STATS_READ_COMMENTS
+            else None),
+    }
+
+
+class ClassifyUrlTest(unittest.TestCase):
+
+    def test_table(self):
+        for url, expected in ROUTE_TABLE:
+            self.assertEqual(classify_url(url), expected, url)
+
+    def test_same_counts_as_old_exports(self):
+        for url, _ in ROUTE_TABLE:
+            if url.startswith('/fanstatic/'):
+                # Static files are not part of the annotated requests
+                continue
+            self.assertEqual(
+                _route_counters(classify_url(url)), _old_counters(url), url)
+
+    def test_proposal(self):
+        self.assertEqual(
+            classify_url('/i/grundsaetze/proposal/12-Titel'),
+            Route(ROUTE_PROPOSAL, 'grundsaetze', 12, None, None, None))
+
+    def test_static(self):
+        self.assertEqual(classify_url('/fanstatic/app.js').kind, ROUTE_STATIC)
+
+    def test_stats_page(self):
+        route = classify_url(
+            '/stats/on_page?page=/i/grundsaetze/proposal/3-x')
+        self.assertEqual(route, Route(
+            ROUTE_STATS_PAGE, 'grundsaetze', 3, None, None,
+            '/i/grundsaetze/proposal/3-x'))
+
+    def test_read_comments(self):
+        route = classify_url(
+            '/stats/read_comments?path=/i/grundsaetze/proposal/3-x')
+        self.assertEqual(route, Route(
+            ROUTE_STATS_READ_COMMENTS, 'grundsaetze', 3, None, None,
+            '/i/grundsaetze/proposal/3-x'))
+
+    def test_other(self):
+        self.assertEqual(
+            classify_url('/i/grundsaetze/instance/grundsaetze'),
+            Route(ROUTE_OTHER, 'grundsaetze', None, None, None, None))
+
+    def test_route_from_row(self):
+        url = '/i/grundsaetze/proposal/12-Titel'
+        self.assertEqual(
+            route_from_row(url, (ROUTE_PROPOSAL, 'grundsaetze', 12, None,
+                                 None)),
+            classify_url(url))
+        # Not annotated
+        self.assertEqual(
+            route_from_row(url, (None, None, None, None, None)),
+            classify_url(url))
+
+
+_Request = collections.namedtuple(
+    '_Request', ['access_time', 'duration', 'route'])
+
+
+def _request(access_time, url, duration=None):
+    return _Request(access_time, duration, classify_url(url))
+
+
+class AddProposalViewsTest(unittest.TestCase):
+
+    def test_views(self):
+        page = '/i/grundsaetze/proposal/7-Titel'
+        other = '/i/grundsaetze/proposal/8-Titel'
+        by_proposal = collections.defaultdict(ViewStats)
+        add_proposal_views(by_proposal, [
+            _request(100, page, duration=60),
+            _request(120, '/stats/on_page?page=' + page.replace('/', '%2F')),
+            _request(130, '/stats/read_comments?path=' + page),
+            _request(150, page + '/rate.json'),
+            _request(200, '/i/grundsaetze/proposal'),
+            # Not attributed to a page view by annotate_requests
+            _request(300, '/stats/read_comments?path=' + other),
+            _request(400, page),
+        ])
+        self.assertEqual(sorted(by_proposal), [7, 8])
+        vdata = by_proposal[7]
+        self.assertEqual(vdata.request_timestamps, [100, 150, 400])
+        self.assertEqual(vdata.duration, 300)
+        self.assertEqual(vdata.read_comments_count, 1)
+        vdata = by_proposal[8]
+        self.assertEqual(vdata.request_timestamps, [300])
+        self.assertEqual(vdata.duration, 0)
+        self.assertEqual(vdata.read_comments_count, 1)
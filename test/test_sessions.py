@@ -0,0 +1,86 @@
+from __future__ import unicode_literals
+
+import collections
+import random
+import unittest
+
+from hhuay.actions_sessions import (
+    _sessionize_loop,
+    _sessionize_numpy,
+    _synthetic_requests,
+)
+
+TIMEOUT = 600
+
+# (id, access_time, tracking_cookie)
+EDGE_ROWS = [
+    (1, 1000, 'a'),
+    # Equal timestamps, of the same and of different cookies
+    (2, 1000, 'a'),
+    (3, 1000, 'b'),
+    # A gap of exactly the timeout continues the session
+    (4, 1000 + TIMEOUT, 'a'),
+    (5, 1000 + TIMEOUT, None),
+    # One second more starts a new one
+    (6, 1000 + 2 * TIMEOUT + 1, 'a'),
+    (7, 1000 + 2 * TIMEOUT + 1, 'b'),
+    (8, 1000 + 2 * TIMEOUT + 1, 'a'),
+    (9, 1000 + 3 * TIMEOUT + 1, 'b'),
+    (10, 1000 + 4 * TIMEOUT + 2, 'b'),
+]
+
+
+def _normalize(sessions):
+    return sorted(
+        (session_id, cookie, first, last, sorted(requests))
+        for session_id, cookie, first, last, requests in sessions)
+
+
+class SessionizeEnginesTest(unittest.TestCase):
+
+    def assertSameSessions(self, rows, timeout):
+        loop_stats = collections.Counter()
+        expected = _normalize(
+            _sessionize_loop(rows, timeout, False, loop_stats))
+        by_cookie_rows = sorted(
+            (r for r in rows if r[2] is not None),
+            key=lambda r: (r[2], r[1], r[0]))
+        self.assertEqual(
+            _normalize(_sessionize_loop(
+                by_cookie_rows, timeout, True, collections.Counter())),
+            expected)
+
+        shuffled = list(rows)
+        random.Random(1).shuffle(shuffled)
+        for numpy_rows in [rows, shuffled]:
+            numpy_stats = collections.Counter()
+            got = _normalize(
+                _sessionize_numpy(numpy_rows, timeout, numpy_stats))
+            self.assertEqual(got, expected)
+            for key in ('with_cookie', 'without_cookie'):
+                self.assertEqual(numpy_stats[key], loop_stats[key], key)
+        return expected
+
+    def test_edge_cases(self):
+        sessions = self.assertSameSessions(EDGE_ROWS, TIMEOUT)
+        self.assertEqual(sessions, [
+            (None, 'a', 1000, 1000 + TIMEOUT, [1, 2, 4]),
+            (None, 'a', 1000 + 2 * TIMEOUT + 1, 1000 + 2 * TIMEOUT + 1,
+             [6, 8]),
+            (None, 'b', 1000, 1000, [3]),
+            (None, 'b', 1000 + 2 * TIMEOUT + 1, 1000 + 3 * TIMEOUT + 1,
+             [7, 9]),
+            (None, 'b', 1000 + 4 * TIMEOUT + 2, 1000 + 4 * TIMEOUT + 2,
+             [10]),
+        ])
+
+    def test_synthetic(self):
+        rows = list(_synthetic_requests(20000))
+        for timeout in [0, 1, 2, 30, TIMEOUT]:
+            self.assertSameSessions(rows, timeout)
+
+    def test_no_cookies(self):
+        self.assertEqual(
+            list(_sessionize_numpy(
+                [(1, 1000, None)], TIMEOUT, collections.Counter())),
+            [])
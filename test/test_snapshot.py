@@ -0,0 +1,54 @@
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from hhuay import snapshot
+
+from .helpers import SQLiteTestCase
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'Snapshots need numpy')
+class SnapshotTest(SQLiteTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.prepare()
+        self.fn = os.path.join(self.tmpdir, 'snap.npz')
+
+    def test_round_trip(self):
+        names = [name for name, _ in snapshot.COLUMNS]
+        with self.connect() as db:
+            count = snapshot.write_snapshot(db, fn=self.fn)
+            db.execute(
+                'SELECT %s FROM analysis_requestlog_combined '
+                'ORDER BY access_time, id' % ', '.join(names))
+            expected = [tuple(row) for row in db]
+
+        snap = snapshot.Snapshot(self.fn)
+        self.assertEqual(count, len(expected))
+        self.assertEqual(len(snap), count)
+        self.assertEqual(snap.rows(names), expected)
+        # There are NULLs in both kinds of columns
+        self.assertIn(None, snap.values('duration'))
+        self.assertIn(None, snap.values('detail_json'))
+
+        mask = snap.column('access_time') % 2 == 0
+        self.assertEqual(
+            snap.rows(['id'], mask),
+            [(row[0],) for row in expected if row[1] % 2 == 0])
+
+    def test_stale_after_reload(self):
+        with self.connect() as db:
+            snapshot.write_snapshot(db, fn=self.fn)
+            self.assertIsNotNone(snapshot.load_fresh_snapshot(db, fn=self.fn))
+
+        self.run_action('load_requestlog')
+        self.run_action('cleanup_requestlog')
+        with self.connect() as db:
+            self.assertIsNone(snapshot.load_fresh_snapshot(db, fn=self.fn))
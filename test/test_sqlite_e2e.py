@@ -0,0 +1,128 @@
+""" The prepare chain, the run stage and the exports on the SQLite backend """
+
+from __future__ import unicode_literals
+
+import argparse
+import re
+
+from hhuay import (
+    actions_tobias_export_habil15,
+    actions_tobias_export_promo16,
+)
+
+from .helpers import (
+    create_platform_tables,
+    SQLiteTestCase,
+)
+
+
+class RecordingSheet(object):
+    """ Stands in for an xlsx worksheet (see xlsx.gen_doc) """
+
+    def __init__(self):
+        self.header = None
+        self.rows = {}
+
+    def freeze_panes(self, row, col):
+        pass
+
+    def write_header(self, columns):
+        self.header = list(columns)
+
+    def write_row(self, row_num, values):
+        self.rows[row_num] = list(values)
+
+    def write_rows(self, rows, row_offset=1):
+        for row_num, row in enumerate(rows, start=row_offset):
+            self.write_row(row_num, row)
+
+
+class SQLiteEndToEndTest(SQLiteTestCase):
+
+    def setUp(self):
+        super(SQLiteEndToEndTest, self).setUp()
+        self.create_requestlog()
+        with self.connect() as db:
+            create_platform_tables(db)
+        self.run_action('load_requestlog')
+        self.run_action('cleanup_requestlog')
+        self.run_action('annotate_requests')
+        self.run_action('assign_requestlog_sessions', '--timeout', '3600')
+        self.run_action('session_user_stats')
+
+    def test_prepare(self):
+        with self.connect() as db:
+            deleted = db.simple_query('''
+                SELECT COUNT(*) FROM analysis_requestlog WHERE deleted''')[0]
+            combined = db.simple_query(
+                'SELECT COUNT(*) FROM analysis_requestlog_combined')[0]
+            sessions = db.simple_query(
+                'SELECT COUNT(*) FROM analysis_session')[0]
+            users = db.simple_query(
+                'SELECT COUNT(*) FROM analysis_session_count_per_user')[0]
+        # 20 bot requests and 20 requests without cookies
+        self.assertEqual(deleted, 40)
+        self.assertTrue(combined > 0)
+        self.assertTrue(sessions > 12)
+        # The logged-in visitors
+        self.assertEqual(users, 6)
+
+    def test_basicfacts(self):
+        out = self.run_action('basicfacts')
+        self.assertIn('12 users\n', out)
+        self.assertIn('5 proposals\n', out)
+        self.assertIn('13 comments\n', out)
+        self.assertIn('28 votes\n', out)
+        self.assertRegex(out, r'\n[0-9]+ page loads\n')
+
+    def test_list_uas(self):
+        out = self.run_action('list_uas', '--summarize')
+        self.assertIn('iPhone', out)
+
+    def test_materialize(self):
+        with self.connect() as db:
+            db.execute('SELECT * FROM analysis_requestlog_combined ORDER BY id')
+            expected = list(db)
+        self.run_action('refresh_requestlog_combined', '--materialize')
+        with self.connect() as db:
+            self.assertFalse(db.view_exists('analysis_requestlog_combined'))
+            db.execute('SELECT * FROM analysis_requestlog_combined ORDER BY id')
+            self.assertEqual(list(db), expected)
+
+    def _check_export(self, module):
+        args = argparse.Namespace(include_proposals=True)
+        with self.connect() as db:
+            sessions = RecordingSheet()
+            module.export_sessions(args, sessions, db, self.config)
+            users = RecordingSheet()
+            module.export_users(users, db)
+            proposals = RecordingSheet()
+            module.export_proposals(proposals, db)
+
+        self.assertTrue(sessions.rows)
+        for row in sessions.rows.values():
+            self.assertEqual(len(row), len(sessions.header))
+        durations = [
+            value
+            for row in sessions.rows.values()
+            for name, value in zip(sessions.header, row)
+            if re.match(r'^V[0-9]+_Duration$', name)]
+        self.assertTrue(any(durations))
+        comments_read = [
+            value
+            for row in sessions.rows.values()
+            for name, value in zip(sessions.header, row)
+            if re.match(r'^V[0-9]+_CommentsRead$', name)]
+        self.assertTrue(any(comments_read))
+
+        # All users but the admin and the deleted one
+        self.assertEqual(len(users.rows), 12)
+        self.assertEqual(
+            sorted(row[0] for row in proposals.rows.values()),
+            [1, 2, 3, 4, 5])
+
+    def test_export_promo16(self):
+        self._check_export(actions_tobias_export_promo16)
+
+    def test_export_habil15(self):
+        self._check_export(actions_tobias_export_habil15)